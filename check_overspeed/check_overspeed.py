@@ -1,21 +1,34 @@
+import os
+import json
+import math
+import threading
+import time
 import numpy as np
 import pandas as pd
-from pyrosm import OSM
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from shapely.geometry import LineString, Point
 from scipy.spatial import KDTree
+from gps_smoother import GPSSmoother, smooth_trip
 
 # ---------------------------------------------------------
 # 1. LOAD OSM ROADS
 # ---------------------------------------------------------
-osm = OSM("tunisia-latest.osm.pbf")   # <- change if needed
+OSM_FILE = "tunisia-latest.osm.pbf"   # <- change if needed
 
-roads = osm.get_data_by_custom_criteria(
-    {"highway": True},
-    relations=False
-)
+# On low-memory devices point this to a directory made by build_tiles()
+# and roads are loaded tile by tile instead of the whole country.
+ROAD_TILE_DIR = os.environ.get("ROAD_TILE_DIR")
 
-# Keep only what we need
-roads = roads[['geometry', 'highway', 'maxspeed']].dropna(subset=['geometry'])
+# Processes on a fleet gateway can instead point this to the socket of a
+# running speed_limit_service.py and skip loading the roads entirely.
+# Only get_speed_limit / check_speed (and OverspeedEpisodeBuilder, which
+# uses check_speed) go through the service; MapMatcher and the lookup
+# sessions need a road index passed with index=.
+SPEED_LIMIT_SOCKET = os.environ.get("SPEED_LIMIT_SOCKET")
+
+DEFAULT_MAXSPEED = 50
 
 # Clean maxspeed (convert from strings like '50', '80', '50 mph')
 def parse_maxspeed(x):
@@ -27,64 +40,447 @@ def parse_maxspeed(x):
     except:
         return np.nan
 
-roads['maxspeed'] = roads['maxspeed'].apply(parse_maxspeed)
 
-# Fill missing speed limits logically (optional)
-roads['maxspeed'] = roads['maxspeed'].fillna(50)
+def load_roads(osm_path):
+    # pyrosm is only needed to read the .osm.pbf (not for tiles, the
+    # speed-limit service or an index built elsewhere)
+    from pyrosm import OSM
+    osm = OSM(osm_path)
+
+    roads = osm.get_data_by_custom_criteria(
+        {"highway": True},
+        relations=False
+    )
+
+    # Keep only what we need
+    roads = roads[['geometry', 'highway', 'maxspeed']].dropna(subset=['geometry'])
+
+    roads['maxspeed'] = roads['maxspeed'].apply(parse_maxspeed)
+
+    # Fill missing speed limits logically (optional)
+    roads['maxspeed'] = roads['maxspeed'].fillna(DEFAULT_MAXSPEED)
+    return roads
 
 # ---------------------------------------------------------
 # 2. BUILD SAMPLE POINTS FOR KDTREE
 # ---------------------------------------------------------
-points = []
-point_to_road = []
-
-for idx, row in roads.iterrows():
-    geom = row['geometry']
-    
-    # If geometry is a LineString
-    if isinstance(geom, LineString):
-        xs, ys = geom.xy
-        for i in range(len(xs)):
-            points.append((ys[i], xs[i]))   # (lat, lon)
-            point_to_road.append(idx)
-    
-    # If MultiLineString
-    else:
+EARTH_RADIUS_M = 6371000.0
+METERS_PER_DEG = 111320.0
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Great-circle distance in meters (works on scalars or arrays)."""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+def bearing_deg(lat1, lon1, lat2, lon2):
+    """Initial bearing from point 1 to point 2 in degrees [0, 360)."""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    y = np.sin(lon2 - lon1) * np.cos(lat2)
+    x = (np.cos(lat1) * np.sin(lat2) -
+         np.sin(lat1) * np.cos(lat2) * np.cos(lon2 - lon1))
+    return (np.degrees(np.arctan2(y, x)) + 360.0) % 360.0
+
+
+def build_sample_points(roads):
+    """Road vertices as a (N, 2) array of (lat, lon) + owning road index."""
+    points = []
+    point_to_road = []
+
+    for idx, row in roads.iterrows():
+        geom = row['geometry']
+
+        # If geometry is a LineString
+        if isinstance(geom, LineString):
+            xs, ys = geom.xy
+            for i in range(len(xs)):
+                points.append((ys[i], xs[i]))   # (lat, lon)
+                point_to_road.append(idx)
+
+        # If MultiLineString
+        else:
+            try:
+                for line in getattr(geom, 'geoms', geom):
+                    xs, ys = line.xy
+                    for i in range(len(xs)):
+                        points.append((ys[i], xs[i]))
+                        point_to_road.append(idx)
+            except:
+                pass
+
+    points = np.array(points, dtype=float).reshape(-1, 2)
+    return points, np.array(point_to_road)
+
+
+def build_road_connectivity(points, point_to_road):
+    """
+    Map each road index to the set of roads sharing at least one vertex
+    with it (OSM ways are connected through shared nodes).
+    """
+    if len(points) == 0:
+        return {}
+    keys = np.round(points, 7)
+    _, vertex_id = np.unique(keys, axis=0, return_inverse=True)
+    pairs = pd.DataFrame({
+        "vertex": vertex_id.ravel(),
+        "road": np.asarray(point_to_road)
+    }).drop_duplicates()
+    shared = pairs[pairs.duplicated("vertex", keep=False)]
+
+    neighbors = {}
+    for _, group in shared.groupby("vertex")["road"]:
+        ids = group.tolist()
+        for r in ids:
+            neighbors.setdefault(r, set()).update(ids)
+    for r, ids in neighbors.items():
+        ids.discard(r)
+    return neighbors
+
+
+class RoadIndex:
+    """KDTree over road vertices plus the road attributes it points to."""
+
+    def __init__(self, roads):
+        self.roads = roads
+        self.points, self.point_to_road = build_sample_points(roads)
+        self.tree = KDTree(self.points) if len(self.points) else None
+        self.neighbors = build_road_connectivity(self.points, self.point_to_road)
+
+    def __contains__(self, road_index):
+        return road_index in self.roads.index
+
+    @property
+    def nbytes(self):
+        """Rough memory footprint: vertex arrays, KDTree and road table."""
+        geom_bytes = 16 * len(self.points)       # coordinates held by shapely
+        return (3 * self.points.nbytes + self.point_to_road.nbytes +
+                geom_bytes + int(self.roads.memory_usage(deep=True).sum()))
+
+    def nearest_road(self, lat, lon, max_dist_deg=np.inf):
+        """(distance in degrees, road index) of the nearest road vertex."""
+        if self.tree is None:
+            return np.inf, None
+        dist, idx = self.tree.query((lat, lon), distance_upper_bound=max_dist_deg)
+        if not np.isfinite(dist):
+            return np.inf, None
+        return dist, self.point_to_road[idx]
+
+    def speed_limit(self, road_index):
+        road_row = self.roads.loc[road_index]
+        return road_row['maxspeed'], road_row['highway']
+
+    def geometry(self, road_index):
+        return self.roads.at[road_index, 'geometry']
+
+    def road_neighbors(self, road_index):
+        return self.neighbors.get(road_index, set())
+
+    def prefetch(self, lat, lon, heading):
+        """Everything is already in memory."""
+        pass
+
+    def candidates(self, lat, lon, k=5, radius_m=50.0):
+        """
+        Up to `k` distinct roads near a fix, nearest first.
+        Returns a list of (road_index, distance_m, road_bearing_deg).
+        """
+        if self.tree is None:
+            return []
+        # Ask for more vertices than roads: long roads own many nearby vertices
+        dists, idxs = self.tree.query((lat, lon), k=4 * k,
+                                      distance_upper_bound=radius_m / METERS_PER_DEG)
+
+        seen = []
+        for d, i in zip(np.atleast_1d(dists), np.atleast_1d(idxs)):
+            if not np.isfinite(d):
+                break
+            road_index = self.point_to_road[i]
+            if road_index not in seen:
+                seen.append(road_index)
+                if len(seen) == k:
+                    break
+
+        fix = Point(lon, lat)
+        candidates = []
+        for road_index in seen:
+            geom = self.geometry(road_index)
+            along = geom.project(fix)
+            snapped = geom.interpolate(along)
+            # Local road direction around the snapped point
+            a = geom.interpolate(max(along - 1e-5, 0.0))
+            b = geom.interpolate(min(along + 1e-5, geom.length))
+            road_bearing = bearing_deg(a.y, a.x, b.y, b.x) if a != b else None
+            dist_m = float(haversine_m(lat, lon, snapped.y, snapped.x))
+            if dist_m <= radius_m:
+                candidates.append((road_index, dist_m, road_bearing))
+        return candidates
+
+# ---------------------------------------------------------
+# 3. TILED ROAD INDEX (LOW-MEMORY DEVICES)
+# ---------------------------------------------------------
+# The whole country as one GeoDataFrame + KDTree does not fit on a
+# Raspberry Pi. build_tiles() splits the roads into a lat/lon grid once
+# (on a desktop); TiledRoadIndex then keeps only the tiles around the
+# vehicle in an LRU cache with a memory cap and prefetches the tiles
+# ahead of the current heading in a background thread.
+
+def tile_key(lat, lon, tile_deg):
+    return (int(math.floor(lat / tile_deg)), int(math.floor(lon / tile_deg)))
+
+
+def build_tiles(roads, out_dir, tile_deg=0.1):
+    """
+    Write one pickle per tile with every road that has a vertex in it,
+    plus a tiles.json manifest. Roads crossing a border go to each tile.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    points, point_to_road = build_sample_points(roads)
+
+    cells = pd.DataFrame({
+        "lat_k": np.floor(points[:, 0] / tile_deg).astype(int),
+        "lon_k": np.floor(points[:, 1] / tile_deg).astype(int),
+        "road": point_to_road
+    }).drop_duplicates()
+
+    keys = []
+    for (lat_k, lon_k), group in cells.groupby(["lat_k", "lon_k"]):
+        tile_roads = roads.loc[group["road"].unique()]
+        tile_roads.to_pickle(os.path.join(out_dir, f"{lat_k}_{lon_k}.pkl"))
+        keys.append([int(lat_k), int(lon_k)])
+
+    with open(os.path.join(out_dir, "tiles.json"), "w") as f:
+        json.dump({"tile_deg": tile_deg, "tiles": keys}, f)
+
+    print(f"Wrote {len(keys)} tiles to {out_dir}")
+    return len(keys)
+
+
+class TiledRoadIndex:
+    """
+    Same lookups as RoadIndex, backed by on-demand tiles.
+
+    max_bytes caps the (estimated) memory of cached tiles; the least
+    recently used tiles are dropped first. Lookups by road index reload
+    the road's tile if it was dropped (a matcher may still hold the road).
+    """
+
+    def __init__(self, tile_dir, max_bytes=64 * 1024 * 1024, prefetch=True):
+        with open(os.path.join(tile_dir, "tiles.json")) as f:
+            manifest = json.load(f)
+        self.tile_dir = tile_dir
+        self.tile_deg = manifest["tile_deg"]
+        self.available = {tuple(k) for k in manifest["tiles"]}
+        self.max_bytes = max_bytes
+
+        self._tiles = OrderedDict()      # tile key -> RoadIndex
+        self._road_tile = {}             # road index -> a tile holding it (kept on eviction)
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+        self.evictions = 0
+        self.bytes_used = 0
+
+    # ---------- Tile cache ----------
+
+    def _load(self, key):
+        path = os.path.join(self.tile_dir, f"{key[0]}_{key[1]}.pkl")
+        return RoadIndex(pd.read_pickle(path))
+
+    def _insert(self, key, index):
+        with self._lock:
+            if key in self._tiles:
+                return self._tiles[key]
+            self._tiles[key] = index
+            self.bytes_used += index.nbytes
+            for road_index in index.roads.index:
+                self._road_tile.setdefault(road_index, key)
+            # Never evict the tile we just loaded
+            while self.bytes_used > self.max_bytes and len(self._tiles) > 1:
+                _, old = self._tiles.popitem(last=False)
+                self.bytes_used -= old.nbytes
+                self.evictions += 1
+            return index
+
+    def tile(self, key):
+        """RoadIndex for a tile, or None if the tile has no roads."""
+        if key not in self.available:
+            return None
+        with self._lock:
+            index = self._tiles.get(key)
+            if index is not None:
+                self._tiles.move_to_end(key)
+                self.hits += 1
+                return index
+            self.misses += 1
+        # Disk read outside the lock so prefetching does not block lookups
+        return self._insert(key, self._load(key))
+
+    def _prefetch_one(self, key):
         try:
-            for line in geom:
-                xs, ys = line.xy
-                for i in range(len(xs)):
-                    points.append((ys[i], xs[i]))
-                    point_to_road.append(idx)
-        except:
-            pass
+            self._insert(key, self._load(key))
+            with self._lock:
+                self.prefetched += 1
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def prefetch(self, lat, lon, heading):
+        """Load the tiles ahead of (and diagonally ahead of) the vehicle."""
+        if self._executor is None or heading is None:
+            return
+        for offset in (0.0, -45.0, 45.0):
+            h = math.radians(heading + offset)
+            key = tile_key(lat + math.cos(h) * self.tile_deg,
+                           lon + math.sin(h) * self.tile_deg, self.tile_deg)
+            with self._lock:
+                if (key not in self.available or key in self._tiles or
+                        key in self._pending):
+                    continue
+                self._pending.add(key)
+            self._executor.submit(self._prefetch_one, key)
+
+    def _tiles_near(self, lat, lon, radius_deg):
+        lat_lo, lon_lo = tile_key(lat - radius_deg, lon - radius_deg, self.tile_deg)
+        lat_hi, lon_hi = tile_key(lat + radius_deg, lon + radius_deg, self.tile_deg)
+        home = tile_key(lat, lon, self.tile_deg)
+        keys = [home] + [(a, b)
+                         for a in range(lat_lo, lat_hi + 1)
+                         for b in range(lon_lo, lon_hi + 1)
+                         if (a, b) != home]
+        tiles = []
+        for key in keys:
+            index = self.tile(key)
+            if index is not None:
+                tiles.append(index)
+        return tiles
+
+    def _find(self, road_index):
+        with self._lock:
+            tiles = list(reversed(self._tiles.values()))
+            key = self._road_tile.get(road_index)
+        for index in tiles:
+            if road_index in index:
+                return index
+        if key is None:
+            raise KeyError(f"road {road_index} is in no tile loaded so far")
+        return self.tile(key)       # evicted since: load it again
+
+    # ---------- RoadIndex interface ----------
 
-points = np.array(points)
+    def nearest_road(self, lat, lon, max_dist_deg=np.inf):
+        home = self.tile(tile_key(lat, lon, self.tile_deg))
+        best = home.nearest_road(lat, lon, max_dist_deg) if home else (np.inf, None)
 
-tree = KDTree(points)
+        # A closer vertex may sit just across a tile border
+        radius = min(best[0], max_dist_deg, self.tile_deg)
+        for index in self._tiles_near(lat, lon, radius):
+            if index is home:
+                continue
+            found = index.nearest_road(lat, lon, radius)
+            if found[0] < best[0]:
+                best = found
+        return best
+
+    def speed_limit(self, road_index):
+        return self._find(road_index).speed_limit(road_index)
+
+    def geometry(self, road_index):
+        return self._find(road_index).geometry(road_index)
+
+    def road_neighbors(self, road_index):
+        linked = set()
+        with self._lock:
+            tiles = list(self._tiles.values())
+        for index in tiles:
+            linked |= index.road_neighbors(road_index)
+        return linked
+
+    def candidates(self, lat, lon, k=5, radius_m=50.0):
+        found = {}
+        for index in self._tiles_near(lat, lon, radius_m / METERS_PER_DEG):
+            for road_index, dist_m, road_bearing in index.candidates(lat, lon, k, radius_m):
+                if road_index not in found or dist_m < found[road_index][1]:
+                    found[road_index] = (road_index, dist_m, road_bearing)
+        return sorted(found.values(), key=lambda c: c[1])[:k]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "prefetched": self.prefetched,
+                "evictions": self.evictions,
+                "tiles_cached": len(self._tiles),
+                "bytes_used": self.bytes_used,
+                "max_bytes": self.max_bytes
+            }
+
+
+if ROAD_TILE_DIR:
+    spatial_index = TiledRoadIndex(ROAD_TILE_DIR)
+    print("Tiled road index ready. Tiles available:", len(spatial_index.available))
+elif SPEED_LIMIT_SOCKET:
+    from speed_limit_service import SpeedLimitClient
+    spatial_index = None
+    service_client = SpeedLimitClient(SPEED_LIMIT_SOCKET)
+    print("Using speed-limit service at", SPEED_LIMIT_SOCKET)
+else:
+    roads = load_roads(OSM_FILE)
+    spatial_index = RoadIndex(roads)
+    points, point_to_road, tree = (spatial_index.points,
+                                   spatial_index.point_to_road,
+                                   spatial_index.tree)
+    print("KD-tree ready. Total points:", len(points))
+
+
+def _road_index(index, who):
+    """`index`, or the module road index; fails clearly in socket mode."""
+    if index is None:
+        index = spatial_index
+    if index is None:
+        raise RuntimeError(
+            f"{who} needs a road index, but roads are served by the speed-limit "
+            f"service at SPEED_LIMIT_SOCKET={SPEED_LIMIT_SOCKET}; pass index= "
+            "or use check_speed() / get_speed_limit()")
+    return index
 
-print("KD-tree ready. Total points:", len(points))
 
 # ---------------------------------------------------------
-# 3. FUNCTION: GET SPEED LIMIT FROM A GPS POSITION
+# 4. FUNCTION: GET SPEED LIMIT FROM A GPS POSITION
 # ---------------------------------------------------------
 def get_speed_limit(lat, lon):
+    if spatial_index is None:
+        return service_client.get_speed_limit(lat, lon)
+
     # Find nearest road point
-    dist, idx = tree.query((lat, lon))
-    road_index = point_to_road[idx]
-    road_row = roads.loc[road_index]
-    return road_row['maxspeed'], road_row['highway']
+    dist, road_index = spatial_index.nearest_road(lat, lon)
+    if road_index is None:
+        return DEFAULT_MAXSPEED, None
+    return spatial_index.speed_limit(road_index)
 
 
 # ---------------------------------------------------------
-# 4. FUNCTION: CHECK OVERSPEED
+# 5. FUNCTION: CHECK OVERSPEED
 # ---------------------------------------------------------
 def check_speed(current_speed, lat, lon):
     limit, road_type = get_speed_limit(lat, lon)
-    
+    return speed_verdict(current_speed, limit, road_type)
+
+
+def speed_verdict(current_speed, limit, road_type):
+    """OK / OVER_SPEED verdict for a speed against a known limit."""
     # tolerance rule
     tolerance = max(5, limit * 0.05)
-    
+
     if current_speed > limit + tolerance:
         return {
             "status": "OVER_SPEED",
@@ -103,13 +499,494 @@ def check_speed(current_speed, lat, lon):
 
 
 # ---------------------------------------------------------
-# 5. EXAMPLE USAGE
+# 6. ONLINE HMM MAP MATCHING
 # ---------------------------------------------------------
-gps_points = [
-    (36.80625, 10.18105, 48),
-    (36.80630, 10.18120, 45),
-    (36.80633, 10.18140, 60)
-]
+# Snapping every fix on its own flickers between parallel roads
+# (highway vs. service road). The matcher below runs a Viterbi pass over
+# the few nearest road candidates of each fix, so switching roads costs
+# something unless the roads are connected and the heading agrees.
+
+def _heading_mismatch(heading, road_bearing):
+    """Angle in [0, 90] between a heading and an (undirected) road."""
+    if heading is None or road_bearing is None:
+        return 0.0
+    diff = abs(heading - road_bearing) % 180.0
+    return min(diff, 180.0 - diff)
+
+
+class MapMatcher:
+    """
+    Incremental Viterbi map matcher for one vehicle.
+
+    Per-step cost is bounded by `k_candidates ** 2` and memory by
+    `window` steps, so it can run online on the edge device. Use
+    `match_trip` for offline trips.
+
+    Online answers are fixed-lag: the vehicle is only moved to a new road
+    once the best Viterbi path has stayed on it for the last `lag` fixes
+    (lag=1 gives the raw per-fix argmin).
+    """
+
+    def __init__(self, k_candidates=5, search_radius_m=50.0, gps_sigma_m=10.0,
+                 switch_cost=1.0, jump_cost=8.0, heading_weight=2.0,
+                 min_move_m=2.0, window=10, lag=3, index=None):
+        self.k_candidates = k_candidates
+        self.search_radius_m = search_radius_m
+        self.gps_sigma_m = gps_sigma_m
+        self.switch_cost = switch_cost          # change to a connected road
+        self.jump_cost = jump_cost              # change to an unconnected road
+        self.heading_weight = heading_weight
+        self.min_move_m = min_move_m
+        self.window = window
+        self.lag = lag
+        self.index = _road_index(index, "MapMatcher")
+        self.reset()
+
+    def reset(self):
+        # Each step: (road indices, accumulated costs, backpointers)
+        self.steps = deque(maxlen=self.window)
+        self.prev_fix = None
+        self.road = None            # road the online answer is committed to
+
+    def _transition_costs(self, prev_roads, roads_now):
+        costs = np.empty((len(prev_roads), len(roads_now)))
+        for i, r_prev in enumerate(prev_roads):
+            linked = self.index.road_neighbors(r_prev)
+            for j, r in enumerate(roads_now):
+                if r == r_prev:
+                    costs[i, j] = 0.0
+                elif r in linked:
+                    costs[i, j] = self.switch_cost
+                else:
+                    costs[i, j] = self.jump_cost
+        return costs
+
+    def update(self, lat, lon):
+        """
+        Feed one fix. Returns the matched road index, or None if no road
+        is within `search_radius_m`. The chain is kept so the caller can
+        still read best_path(); call reset() before the next fix.
+        """
+        heading = None
+        if self.prev_fix is not None:
+            moved = haversine_m(self.prev_fix[0], self.prev_fix[1], lat, lon)
+            if moved >= self.min_move_m:
+                heading = float(bearing_deg(self.prev_fix[0], self.prev_fix[1],
+                                            lat, lon))
+                self.index.prefetch(lat, lon, heading)
+
+        candidates = self.index.candidates(lat, lon, self.k_candidates,
+                                           self.search_radius_m)
+        if not candidates:
+            return None
+
+        road_ids = [c[0] for c in candidates]
+        emission = np.array([
+            0.5 * (dist_m / self.gps_sigma_m) ** 2 +
+            self.heading_weight * (_heading_mismatch(heading, rb) / 90.0) ** 2
+            for _, dist_m, rb in candidates
+        ])
+
+        if not self.steps:
+            cost = emission
+            back = np.full(len(road_ids), -1)
+        else:
+            prev_roads, prev_cost, _ = self.steps[-1]
+            total = prev_cost[:, None] + self._transition_costs(prev_roads, road_ids)
+            back = np.argmin(total, axis=0)
+            cost = total[back, np.arange(len(road_ids))] + emission
+
+        # Keep costs bounded over long trips
+        cost = cost - cost.min()
+        self.steps.append((road_ids, cost, back))
+        self.prev_fix = (lat, lon)
+
+        # Fixed lag: switch only once the best path agrees for `lag` fixes
+        recent = self.best_path(self.lag)
+        if self.road is None or self.road not in road_ids or len(set(recent)) == 1:
+            self.road = recent[-1]
+        return self.road
+
+    def best_path(self, last=None):
+        """
+        Most likely road sequence over the current lookback window (or only
+        its `last` steps, which costs O(last) instead of O(window)).
+        """
+        if not self.steps:
+            return []
+        j = int(np.argmin(self.steps[-1][1]))
+        path = []
+        for road_ids, _, back in reversed(self.steps):
+            path.append(road_ids[j])
+            if last is not None and len(path) == last:
+                break
+            j = int(back[j])
+        path.reverse()
+        return path
+
+    def get_speed_limit(self, lat, lon):
+        road_index = self.update(lat, lon)
+        if road_index is None:
+            # Gap: restart the chain and fall back to the nearest road
+            self.reset()
+            return get_speed_limit(lat, lon)
+        return self.index.speed_limit(road_index)
+
+    def check_speed(self, current_speed, lat, lon):
+        limit, road_type = self.get_speed_limit(lat, lon)
+        return speed_verdict(current_speed, limit, road_type)
+
+
+def match_trip(fixes, **matcher_kwargs):
+    """
+    Batch map matching for an offline trip.
+    fixes: iterable of (lat, lon, ...). Returns one road index per fix
+    (None where no road was in range), using full-trip Viterbi.
+    """
+    matcher = MapMatcher(**matcher_kwargs)
+    matcher.window = None
+    matcher.reset()
+
+    matched = []
+    for fix in fixes:
+        if matcher.update(fix[0], fix[1]) is None:
+            # Close the chain before the gap, then start a new one
+            matched.extend(matcher.best_path())
+            matched.append(None)
+            matcher.reset()
+    matched.extend(matcher.best_path())
+    return matched
+
+
+# ---------------------------------------------------------
+# 7. PER-VEHICLE LOOKUP SESSIONS (ROAD STICKINESS)
+# ---------------------------------------------------------
+# At 1-10 Hz consecutive fixes are almost always on the same road. A
+# session remembers the road segment the vehicle is on and answers with
+# a point-to-segment check while the fix stays inside a corridor around
+# it (or its two adjacent segments); the KDTree is only queried again
+# once the vehicle leaves the corridor.
+
+def _segment_distance_m(a_lat, a_lon, b_lat, b_lon, lat, lon):
+    """Distance from a fix to segment A-B in meters (local flat-earth)."""
+    kx = METERS_PER_DEG * math.cos(math.radians(lat))
+    ax, ay = (a_lon - lon) * kx, (a_lat - lat) * METERS_PER_DEG
+    bx, by = (b_lon - lon) * kx, (b_lat - lat) * METERS_PER_DEG
+    dx, dy = bx - ax, by - ay
+    length2 = dx * dx + dy * dy
+    t = 0.0 if length2 == 0 else min(1.0, max(0.0, -(ax * dx + ay * dy) / length2))
+    return math.hypot(ax + t * dx, ay + t * dy)
+
+
+def _nearest_segment(geom, lat, lon):
+    """(distance_m, vertex list [(lat, lon), ...], segment index) on a road."""
+    best = (np.inf, None, 0)
+    for line in getattr(geom, 'geoms', [geom]):
+        coords = [(y, x) for x, y in np.asarray(line.coords)[:, :2]]
+        for seg in range(len(coords) - 1):
+            d = _segment_distance_m(*coords[seg], *coords[seg + 1], lat, lon)
+            if d < best[0]:
+                best = (d, coords, seg)
+    return best
+
+
+class VehicleLookupSession:
+    """Sticky speed-limit lookups for one vehicle."""
+
+    __slots__ = ("index", "corridor_m", "road_index", "limit", "road_type",
+                 "coords", "seg", "hits", "misses", "last_seen",
+                 "smoother", "last_verdict")
+
+    def __init__(self, corridor_m=15.0, index=None, smoother=None):
+        self.index = _road_index(index, "VehicleLookupSession")
+        self.corridor_m = corridor_m
+        self.road_index = None
+        self.limit = DEFAULT_MAXSPEED
+        self.road_type = None
+        self.coords = None      # vertices of the current road part
+        self.seg = 0            # current segment: coords[seg] -> coords[seg + 1]
+        self.hits = 0
+        self.misses = 0
+        self.last_seen = 0.0
+        self.smoother = smoother    # optional GPSSmoother for this vehicle's fixes
+        self.last_verdict = None
+
+    def _in_corridor(self, lat, lon):
+        coords = self.coords
+        for seg in (self.seg, self.seg + 1, self.seg - 1):
+            if 0 <= seg < len(coords) - 1:
+                d = _segment_distance_m(*coords[seg], *coords[seg + 1], lat, lon)
+                if d <= self.corridor_m:
+                    self.seg = seg
+                    return True
+        return False
+
+    def get_speed_limit(self, lat, lon):
+        if self.coords is not None and self._in_corridor(lat, lon):
+            self.hits += 1
+            return self.limit, self.road_type
+
+        # Left the corridor: fall back to the global index, preferring the
+        # road whose geometry (not just a vertex) is closest
+        self.misses += 1
+        candidates = self.index.candidates(lat, lon, k=3, radius_m=4 * self.corridor_m)
+        if candidates:
+            road_index = min(candidates, key=lambda c: c[1])[0]
+        else:
+            dist, road_index = self.index.nearest_road(lat, lon)
+        if road_index is None:
+            self.road_index, self.coords = None, None
+            return DEFAULT_MAXSPEED, None
+
+        self.road_index = road_index
+        self.limit, self.road_type = self.index.speed_limit(road_index)
+        _, self.coords, self.seg = _nearest_segment(self.index.geometry(road_index), lat, lon)
+        return self.limit, self.road_type
+
+    def check_speed(self, current_speed, lat, lon, timestamp=None):
+        if self.smoother is not None:
+            fix = self.smoother.update(lat, lon, current_speed, timestamp)
+            if fix is None:
+                # Outlier or not due at the smoothed rate: nothing new to look up
+                return self.last_verdict
+            lat, lon, current_speed = fix
+        limit, road_type = self.get_speed_limit(lat, lon)
+        self.last_verdict = speed_verdict(current_speed, limit, road_type)
+        return self.last_verdict
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class LookupSessions:
+    """
+    One VehicleLookupSession per vehicle id, for many vehicles per process.
+    smoother: optional factory (e.g. GPSSmoother) giving each vehicle its
+    own GPS smoothing pre-stage.
+    """
+
+    def __init__(self, corridor_m=15.0, idle_timeout_s=600.0, index=None, smoother=None):
+        self.corridor_m = corridor_m
+        self.idle_timeout_s = idle_timeout_s
+        self.index = _road_index(index, "LookupSessions")
+        self.smoother = smoother
+        self.sessions = {}
+
+    def get(self, vehicle_id):
+        session = self.sessions.get(vehicle_id)
+        if session is None:
+            session = VehicleLookupSession(self.corridor_m, self.index,
+                                           self.smoother() if self.smoother else None)
+            self.sessions[vehicle_id] = session
+        session.last_seen = time.monotonic()
+        return session
+
+    def check_speed(self, vehicle_id, current_speed, lat, lon, timestamp=None):
+        return self.get(vehicle_id).check_speed(current_speed, lat, lon, timestamp)
+
+    def evict_idle(self):
+        """Drop sessions of vehicles not seen for idle_timeout_s."""
+        cutoff = time.monotonic() - self.idle_timeout_s
+        idle = [v for v, s in self.sessions.items() if s.last_seen < cutoff]
+        for vehicle_id in idle:
+            del self.sessions[vehicle_id]
+        return len(idle)
+
+    def stats(self):
+        hits = sum(s.hits for s in self.sessions.values())
+        misses = sum(s.misses for s in self.sessions.values())
+        return {
+            "sessions": len(self.sessions),
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0
+        }
+
+
+# ---------------------------------------------------------
+# 8. OVERSPEED EPISODES
+# ---------------------------------------------------------
+# check_speed gives one verdict per fix; uploading those would swamp the
+# backend. The builder below folds consecutive verdicts into episodes:
+# an episode opens on the first OVER_SPEED fix, stays open while the
+# speed is above the limit (hysteresis: dropping back inside the
+# tolerance band does not close it), and closes once the vehicle has
+# been at or under the limit for exit_hold_s. Every fix until then adds
+# to the episode's distance and end; only fixes above the exit margin
+# count towards the excess statistics. Episodes shorter than
+# min_duration_s are dropped as noise.
+
+class OverspeedEpisodeBuilder:
+    """Streaming OVER_SPEED episode builder for one vehicle."""
+
+    def __init__(self, min_duration_s=3.0, exit_hold_s=2.0, exit_margin_kmh=0.0,
+                 lookup=None, smoother=None):
+        self.min_duration_s = min_duration_s
+        self.exit_hold_s = exit_hold_s
+        self.exit_margin_kmh = exit_margin_kmh
+        self.lookup = check_speed if lookup is None else lookup
+        self.smoother = smoother    # optional GPSSmoother in front of the lookups
+        self.episode = None
+        self.prev = None            # (timestamp, speed) of the previous fix
+        self.below_since = None
+
+    def _open(self, verdict, timestamp, excess):
+        self.episode = {
+            "start": timestamp,
+            "end": timestamp,
+            "peak_excess": excess,
+            "peak_speed": verdict["speed"],
+            "limit": verdict["limit"],
+            "excess_sum": 0.0,
+            "fixes": 0,
+            "distance_m": 0.0,
+            "road_types": {}
+        }
+
+    def _extend(self, timestamp, step_m):
+        self.episode["end"] = timestamp
+        self.episode["distance_m"] += step_m
+
+    def _add(self, verdict, timestamp, excess, step_m=0.0):
+        self._extend(timestamp, step_m)
+        ep = self.episode
+        ep["excess_sum"] += excess
+        ep["fixes"] += 1
+        road_type = verdict.get("road_type")
+        ep["road_types"][road_type] = ep["road_types"].get(road_type, 0) + 1
+        if excess > ep["peak_excess"]:
+            ep["peak_excess"] = excess
+            ep["peak_speed"] = verdict["speed"]
+            ep["limit"] = verdict["limit"]
+
+    def _close(self):
+        ep, self.episode, self.below_since = self.episode, None, None
+        duration = ep["end"] - ep["start"]
+        if duration < self.min_duration_s:
+            return None
+        return {
+            "start": ep["start"],
+            "end": ep["end"],
+            "duration_s": round(duration, 2),
+            "peak_excess": round(float(ep["peak_excess"]), 1),
+            "mean_excess": round(float(ep["excess_sum"] / ep["fixes"]), 1),
+            "peak_speed": float(ep["peak_speed"]),
+            "limit": float(ep["limit"]),
+            "distance_m": round(ep["distance_m"], 1),
+            "road_type": max(ep["road_types"], key=ep["road_types"].get),
+            "fixes": ep["fixes"]
+        }
+
+    def update(self, verdict, timestamp):
+        """
+        Feed one check_speed verdict with its timestamp (seconds).
+        Returns a finished episode dict, else None.
+        """
+        speed = verdict["speed"]
+        excess = speed - verdict["limit"]
+
+        # Distance covered since the previous fix (km/h -> m/s)
+        step_m = 0.0
+        if self.prev is not None:
+            dt = max(0.0, timestamp - self.prev[0])
+            step_m = (speed + self.prev[1]) / 2 / 3.6 * dt
+        self.prev = (timestamp, speed)
+
+        if self.episode is None:
+            if verdict["status"] == "OVER_SPEED":
+                self._open(verdict, timestamp, excess)
+                self._add(verdict, timestamp, excess)
+            return None
+
+        if excess > self.exit_margin_kmh:
+            self.below_since = None
+            self._add(verdict, timestamp, excess, step_m)
+            return None
+
+        # Still open in the hysteresis band: the vehicle keeps covering ground
+        self._extend(timestamp, step_m)
+        if self.below_since is None:
+            self.below_since = timestamp
+        if timestamp - self.below_since >= self.exit_hold_s:
+            return self._close()
+        return None
+
+    def feed(self, current_speed, lat, lon, timestamp):
+        """Look up the limit for a fix and update the episode state."""
+        if self.smoother is not None:
+            fix = self.smoother.update(lat, lon, current_speed, timestamp)
+            if fix is None:
+                return None
+            lat, lon, current_speed = fix
+        return self.update(self.lookup(current_speed, lat, lon), timestamp)
+
+    def flush(self):
+        """Close any open episode (end of trip)."""
+        if self.episode is None:
+            return None
+        return self._close()
+
+
+def episode_severity(episode):
+    if episode["peak_excess"] >= 30 or episode["duration_s"] >= 60:
+        return "high"
+    if episode["peak_excess"] >= 15 or episode["duration_s"] >= 20:
+        return "medium"
+    return "low"
+
+
+def episode_to_incident(episode, device_id):
+    """Backend `incident` payload (same shape the dashboard already reads)."""
+    return {
+        "deviceId": device_id,
+        "type": "incident",
+        "timestamp": datetime.fromtimestamp(episode["start"]).isoformat(),
+        "values": {
+            "incidentType": "Overspeed",
+            "severity": episode_severity(episode),
+            **episode
+        }
+    }
+
+
+# ---------------------------------------------------------
+# 9. EXAMPLE USAGE
+# ---------------------------------------------------------
+if __name__ == "__main__":
+    gps_points = [
+        (36.80625, 10.18105, 48),
+        (36.80630, 10.18120, 45),
+        (36.80633, 10.18140, 60)
+    ]
+
+    for lat, lon, speed in gps_points:
+        print(check_speed(speed, lat, lon))
+
+    # The matcher and the sessions need the roads in this process
+    if spatial_index is not None:
+        # Same fixes through the map matcher (no flicker between parallel roads)
+        matcher = MapMatcher()
+        for lat, lon, speed in gps_points:
+            print(matcher.check_speed(speed, lat, lon))
+        print("Matched trip:", match_trip(gps_points))
+
+        # Per-vehicle sessions skip the KDTree while the car stays on its road;
+        # each vehicle's fixes are smoothed (and outliers dropped) first
+        sessions = LookupSessions(smoother=GPSSmoother)
+        for lat, lon, speed in gps_points:
+            print(sessions.check_speed("vehicle-1", speed, lat, lon))
+        print("Lookup sessions:", sessions.stats())
+
+    # Fold per-fix verdicts into overspeed episodes (one record per event)
+    builder = OverspeedEpisodeBuilder(min_duration_s=0.0)
+    t0 = time.time()
+    for i, (lat, lon, speed) in enumerate(gps_points):
+        builder.feed(speed, lat, lon, t0 + i)
+    episode = builder.flush()
+    if episode is not None:
+        print(episode_to_incident(episode, "driver-monitor-001"))
 
-for lat, lon, speed in gps_points:
-    print(check_speed(speed, lat, lon))
+    if isinstance(spatial_index, TiledRoadIndex):
+        print("Tile cache:", spatial_index.stats())
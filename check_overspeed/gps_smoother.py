@@ -0,0 +1,253 @@
+"""
+GPS smoothing pre-stage.
+
+Constant-velocity Kalman filter on local east/north metres, with an
+innovation gate that drops outlier fixes and optional downsampling to an
+effective output rate. Put it in front of check_speed / TurnDetector so position
+jitter does not turn into spurious heading changes, lookups and training
+samples.
+
+    smoother = GPSSmoother()
+    fix = smoother.update(lat, lon, speed, timestamp)   # None: dropped or skipped
+    lats, lons, speeds, times = smooth_trip(lats, lons, speeds, timestamps)
+"""
+import math
+import numpy as np
+from scipy.signal import lfilter, ss2tf
+
+METERS_PER_DEG_LAT = 111320.0
+
+
+def _to_local(lats, lons, lat0, lon0):
+    """(lat, lon) -> (east, north) metres around (lat0, lon0)."""
+    east = (np.asarray(lons) - lon0) * METERS_PER_DEG_LAT * np.cos(np.radians(lat0))
+    north = (np.asarray(lats) - lat0) * METERS_PER_DEG_LAT
+    return east, north
+
+
+def _to_latlon(east, north, lat0, lon0):
+    lat = lat0 + np.asarray(north) / METERS_PER_DEG_LAT
+    lon = lon0 + np.asarray(east) / (METERS_PER_DEG_LAT * np.cos(np.radians(lat0)))
+    return lat, lon
+
+
+def _cv_model(dt, accel_sigma):
+    """Transition and process noise of a constant-velocity model (one axis)."""
+    F = np.array([[1.0, dt], [0.0, 1.0]])
+    G = np.array([[0.5 * dt * dt], [dt]])
+    return F, (G @ G.T) * accel_sigma ** 2
+
+
+def steady_state_gain(dt, gps_sigma_m=5.0, accel_sigma=0.5, iterations=500):
+    """Converged Kalman gain [position, velocity] for a fixed fix interval."""
+    F, Q = _cv_model(dt, accel_sigma)
+    R = gps_sigma_m ** 2
+    P = np.diag([R, 100.0])
+    K = np.zeros(2)
+    for _ in range(iterations):
+        P = F @ P @ F.T + Q
+        K = P[:, 0] / (P[0, 0] + R)
+        P = P - np.outer(K, P[0])
+    return K
+
+
+# ---------------------------------------------------------
+# STREAMING
+# ---------------------------------------------------------
+class GPSSmoother:
+    """
+    Streaming smoother for one vehicle.
+
+    accel_sigma (m/s^2) is how hard the vehicle is assumed to manoeuvre:
+    lower is smoother on straights but lags more through sharp bends.
+
+    Every accepted fix updates the filter and is emitted; with out_hz set,
+    a fix is only emitted once per 1 / out_hz seconds. Fixes whose
+    innovation is beyond gate_sigma are dropped; after max_rejects in a
+    row the filter restarts at the new position (the vehicle really
+    moved, e.g. leaving a tunnel).
+    """
+
+    def __init__(self, gps_sigma_m=5.0, accel_sigma=0.5, gate_sigma=4.0,
+                 max_rejects=5, out_hz=None, default_dt=1.0):
+        self.gps_sigma_m = gps_sigma_m
+        self.accel_sigma = accel_sigma
+        self.gate_sigma = gate_sigma
+        self.max_rejects = max_rejects
+        self.out_hz = out_hz
+        self.default_dt = default_dt
+        self.reset()
+
+    def reset(self):
+        self.origin = None          # (lat0, lon0) of the local frame
+        self.m_per_deg_lon = None
+        # State per axis (east, north): position and velocity. Both axes
+        # see the same dt and noise, so they share one covariance p00/p01/p11.
+        self.e = self.n = self.ve = self.vn = 0.0
+        self.p00 = self.p01 = self.p11 = 0.0
+        self.last_t = None
+        self.last_emit_t = None
+        self.rejects = 0
+        self.speed_sum = 0.0
+        self.speed_count = 0
+        self.fixes_in = 0
+        self.fixes_out = 0
+        self.fixes_rejected = 0
+
+    def _start(self, east, north):
+        self.e, self.n, self.ve, self.vn = east, north, 0.0, 0.0
+        self.p00, self.p01, self.p11 = self.gps_sigma_m ** 2, 0.0, 100.0
+        self.rejects = 0
+
+    def update(self, lat, lon, speed, timestamp=None):
+        """
+        Feed one raw fix (timestamp in seconds; default_dt apart if None).
+        Returns the smoothed (lat, lon, speed) when a fix is due, else None.
+        """
+        self.fixes_in += 1
+        t = timestamp
+        if t is None:
+            t = 0.0 if self.last_t is None else self.last_t + self.default_dt
+
+        if self.origin is None:
+            self.origin = (lat, lon)
+            self.m_per_deg_lon = METERS_PER_DEG_LAT * math.cos(math.radians(lat))
+            self._start(0.0, 0.0)
+            self.last_t = t
+            return self._accept(speed, t)
+
+        east = (lon - self.origin[1]) * self.m_per_deg_lon
+        north = (lat - self.origin[0]) * METERS_PER_DEG_LAT
+        dt = max(t - self.last_t, 1e-3)
+
+        # Predict (constant velocity, white acceleration noise)
+        q = self.accel_sigma ** 2
+        p00 = (self.p00 + 2 * dt * self.p01 + dt * dt * self.p11 +
+               q * dt ** 4 / 4)
+        p01 = self.p01 + dt * self.p11 + q * dt ** 3 / 2
+        p11 = self.p11 + q * dt * dt
+        pe = self.e + dt * self.ve
+        pn = self.n + dt * self.vn
+
+        # Gate on the normalized innovation
+        S = p00 + self.gps_sigma_m ** 2
+        ye, yn = east - pe, north - pn
+        if (ye * ye + yn * yn) / S > self.gate_sigma ** 2:
+            self.rejects += 1
+            self.fixes_rejected += 1
+            if self.rejects <= self.max_rejects:
+                return None
+            self._start(east, north)
+        else:
+            k0, k1 = p00 / S, p01 / S
+            self.e, self.n = pe + k0 * ye, pn + k0 * yn
+            self.ve, self.vn = self.ve + k1 * ye, self.vn + k1 * yn
+            self.p00, self.p01, self.p11 = p00 - k0 * p00, p01 - k0 * p01, p11 - k1 * p01
+            self.rejects = 0
+
+        self.last_t = t
+        return self._accept(speed, t)
+
+    def _accept(self, speed, t):
+        self.speed_sum += speed
+        self.speed_count += 1
+        if (self.out_hz is not None and self.last_emit_t is not None and
+                t - self.last_emit_t < 1.0 / self.out_hz - 1e-9):
+            return None
+
+        # Reported speed averaged over the fixes since the last emission
+        out_speed = self.speed_sum / self.speed_count
+        self.speed_sum, self.speed_count = 0.0, 0
+        self.last_emit_t = t
+        self.fixes_out += 1
+        return (self.origin[0] + self.n / METERS_PER_DEG_LAT,
+                self.origin[1] + self.e / self.m_per_deg_lon,
+                float(out_speed))
+
+    def smooth_trip(self, lats, lons, speeds, timestamps=None):
+        """smooth_trip with this smoother's settings."""
+        return smooth_trip(lats, lons, speeds, timestamps,
+                           gps_sigma_m=self.gps_sigma_m, accel_sigma=self.accel_sigma,
+                           gate_sigma=self.gate_sigma, out_hz=self.out_hz,
+                           default_dt=self.default_dt)
+
+    def stats(self):
+        return {
+            "fixes_in": self.fixes_in,
+            "fixes_out": self.fixes_out,
+            "rejected": self.fixes_rejected
+        }
+
+
+# ---------------------------------------------------------
+# BATCH (whole recorded trip)
+# ---------------------------------------------------------
+def _reject_outliers(east, north, gate_m, window=5):
+    """Mask of fixes within gate_m of the running median of their neighbours."""
+    n = len(east)
+    if n < window:
+        return np.ones(n, dtype=bool)
+    half = window // 2
+    pad = lambda a: np.pad(a, half, mode="edge")
+    windows = np.lib.stride_tricks.sliding_window_view
+    med_e = np.median(windows(pad(east), window), axis=1)
+    med_n = np.median(windows(pad(north), window), axis=1)
+    return np.hypot(east - med_e, north - med_n) <= gate_m
+
+
+def _filter_segment(z, K, dt):
+    """Steady-state Kalman filter over evenly spaced positions, as an IIR filter."""
+    F, _ = _cv_model(dt, 0.0)
+    A = (np.eye(2) - np.outer(K, [1.0, 0.0])) @ F
+    C = np.array([[1.0, 0.0]])
+    # state s_k = x_(k-1):  s_(k+1) = A s_k + K z_k,  position_k = C A s_k + C K z_k
+    b, a = ss2tf(A, K.reshape(2, 1), C @ A, C @ K.reshape(2, 1))
+    z0 = z[0]
+    # Start at the first fix at rest, like GPSSmoother
+    return lfilter(b[0], a, z - z0, axis=0) + z0
+
+
+def smooth_trip(lats, lons, speeds, timestamps=None, gps_sigma_m=5.0, accel_sigma=0.5,
+                gate_sigma=4.0, out_hz=None, default_dt=1.0):
+    """
+    Vectorized smoothing of a whole trip.
+
+    Outliers are fixes further than gate_sigma * gps_sigma_m from the
+    median of their 5 neighbours. The rest (averaged into 1 / out_hz bins
+    if out_hz is set) run through the steady-state filter; gaps of more
+    than two sample intervals restart it. Returns (lats, lons, speeds, timestamps) arrays.
+    """
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    speeds = np.asarray(speeds, dtype=float)
+    n = len(lats)
+    if timestamps is None:
+        timestamps = np.arange(n) * default_dt
+    timestamps = np.asarray(timestamps, dtype=float)
+    if n == 0:
+        return lats, lons, speeds, timestamps
+
+    lat0, lon0 = lats[0], lons[0]
+    east, north = _to_local(lats, lons, lat0, lon0)
+    keep = _reject_outliers(east, north, gate_sigma * gps_sigma_m)
+    east, north, speeds, timestamps = east[keep], north[keep], speeds[keep], timestamps[keep]
+
+    # Downsample: average the fixes falling in each output interval
+    if out_hz is not None:
+        dt = 1.0 / out_hz
+        bins = np.floor((timestamps - timestamps[0]) / dt).astype(np.int64)
+        bins, inverse, counts = np.unique(bins, return_inverse=True, return_counts=True)
+        mean = lambda v: np.bincount(inverse, weights=v) / counts
+        east, north, speeds, timestamps = mean(east), mean(north), mean(speeds), mean(timestamps)
+    else:
+        dt = float(np.median(np.diff(timestamps))) if len(timestamps) > 1 else default_dt
+        bins = np.round((timestamps - timestamps[0]) / dt).astype(np.int64)
+
+    K = steady_state_gain(dt, gps_sigma_m, accel_sigma)
+    z = np.column_stack([east, north])
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(bins) > 2) + 1, [len(z)]])
+    for s, e in zip(starts[:-1], starts[1:]):
+        z[s:e] = _filter_segment(z[s:e], K, dt)
+
+    out_lats, out_lons = _to_latlon(z[:, 0], z[:, 1], lat0, lon0)
+    return out_lats, out_lons, speeds, timestamps
@@ -0,0 +1,296 @@
+"""
+Shared speed-limit lookup service.
+
+One process loads the road index once and serves batched lookups over a
+Unix socket. Other processes use SpeedLimitClient (or set
+SPEED_LIMIT_SOCKET so check_overspeed.check_speed goes through it)
+instead of each loading the roads themselves.
+
+    python speed_limit_service.py serve --workers 4
+    python speed_limit_service.py bench --clients 1 2 4 8
+"""
+import os
+import json
+import time
+import socket
+import struct
+import argparse
+import threading
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+
+DEFAULT_SOCKET = "/tmp/speed_limit.sock"
+
+# ---------------------------------------------------------
+# WIRE PROTOCOL
+# ---------------------------------------------------------
+# request:  op (uint8) | count (uint32) | payload
+#   OP_LOOKUP: count * (lat float64, lon float64)
+#   OP_TYPES:  no payload
+# response: count (uint32) | payload
+#   OP_LOOKUP: count * limit (float32), then count * road type id (uint16)
+#   OP_TYPES:  count bytes of UTF-8 JSON, the list of road type names
+HEADER = struct.Struct("<BI")
+COUNT = struct.Struct("<I")
+OP_LOOKUP = 1
+OP_TYPES = 2
+
+
+def _recv_exact(conn, n):
+    """Read exactly n bytes, or None if the peer closed the connection."""
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        k = conn.recv_into(view[got:])
+        if k == 0:
+            return None
+        got += k
+    return bytes(buf)
+
+
+# ---------------------------------------------------------
+# SHARED ROAD ARRAYS
+# ---------------------------------------------------------
+class SharedRoadArrays:
+    """
+    Road vertices (lat, lon) with the limit and road type of their road,
+    in one shared memory block that every worker maps without copying.
+    """
+
+    def __init__(self, shm, n, road_types):
+        self.shm = shm
+        self.n = n
+        self.road_types = road_types
+        self.points = np.ndarray((n, 2), dtype=np.float64, buffer=shm.buf, offset=0)
+        self.limits = np.ndarray((n,), dtype=np.float32, buffer=shm.buf, offset=16 * n)
+        self.type_ids = np.ndarray((n,), dtype=np.uint16, buffer=shm.buf, offset=20 * n)
+
+    @staticmethod
+    def nbytes_for(n):
+        return 22 * n
+
+    @classmethod
+    def create(cls, road_index):
+        """Flatten a check_overspeed.RoadIndex into shared memory."""
+        import pandas as pd
+
+        rows = road_index.roads.loc[road_index.point_to_road]
+        codes, uniques = pd.factorize(rows['highway'])
+        road_types = [str(u) for u in uniques] + [None]
+        codes[codes < 0] = len(uniques)
+
+        n = len(road_index.points)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, cls.nbytes_for(n)))
+        arrays = cls(shm, n, road_types)
+        arrays.points[:] = road_index.points
+        arrays.limits[:] = rows['maxspeed'].to_numpy(dtype=np.float32)
+        arrays.type_ids[:] = codes
+        return arrays
+
+    @classmethod
+    def attach(cls, name, n, road_types):
+        return cls(shared_memory.SharedMemory(name=name), n, road_types)
+
+    def close(self):
+        # Drop our views before closing the mapping
+        self.points = self.limits = self.type_ids = None
+        self.shm.close()
+
+
+# ---------------------------------------------------------
+# SERVER
+# ---------------------------------------------------------
+def _serve_connection(conn, tree, arrays, types_blob):
+    with conn:
+        while True:
+            header = _recv_exact(conn, HEADER.size)
+            if header is None:
+                return
+            op, count = HEADER.unpack(header)
+
+            if op == OP_TYPES:
+                conn.sendall(COUNT.pack(len(types_blob)) + types_blob)
+                continue
+            if op != OP_LOOKUP:
+                return      # protocol error: drop the client
+
+            payload = _recv_exact(conn, 16 * count)
+            if payload is None:
+                return
+            if count == 0:
+                conn.sendall(COUNT.pack(0))
+                continue
+
+            fixes = np.frombuffer(payload, dtype="<f8").reshape(count, 2)
+            _, idx = tree.query(fixes)
+            conn.sendall(COUNT.pack(count) +
+                         arrays.limits[idx].astype("<f4").tobytes() +
+                         arrays.type_ids[idx].astype("<u2").tobytes())
+
+
+def _worker(listener, shm_name, n, road_types):
+    from scipy.spatial import KDTree
+
+    arrays = SharedRoadArrays.attach(shm_name, n, road_types)
+    # copy_data=False: the tree indexes the shared points in place, so a
+    # worker only owns the tree's own index array
+    tree = KDTree(arrays.points, copy_data=False)
+    types_blob = json.dumps(road_types).encode("utf-8")
+
+    while True:
+        conn, _ = listener.accept()
+        threading.Thread(target=_serve_connection,
+                         args=(conn, tree, arrays, types_blob),
+                         daemon=True).start()
+
+
+def serve(socket_path=DEFAULT_SOCKET, workers=4):
+    """Load the roads once and serve lookups from `workers` processes."""
+    # This process must load the roads itself, not ask a service
+    os.environ.pop("SPEED_LIMIT_SOCKET", None)
+    import check_overspeed as co
+
+    if not isinstance(co.spatial_index, co.RoadIndex):
+        raise RuntimeError("speed-limit service needs the full road index (unset ROAD_TILE_DIR)")
+
+    arrays = SharedRoadArrays.create(co.spatial_index)
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(128)
+
+    # Workers inherit the listening socket and all accept() on it
+    ctx = mp.get_context("fork")
+    procs = [ctx.Process(target=_worker,
+                         args=(listener, arrays.shm.name, arrays.n, arrays.road_types),
+                         daemon=True)
+             for _ in range(workers)]
+    for p in procs:
+        p.start()
+
+    print(f"Speed-limit service on {socket_path}: {arrays.n} points, "
+          f"{arrays.shm.size / 1e6:.1f} MB shared, {workers} workers")
+    try:
+        for p in procs:
+            p.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for p in procs:
+            p.terminate()
+        listener.close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        arrays.close()
+        arrays.shm.unlink()
+
+
+# ---------------------------------------------------------
+# CLIENT
+# ---------------------------------------------------------
+class SpeedLimitClient:
+    """Connection to the speed-limit service (safe to share between threads)."""
+
+    def __init__(self, socket_path=DEFAULT_SOCKET):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self._lock = threading.Lock()
+        self.road_types = self._fetch_types()
+
+    def _fetch_types(self):
+        with self._lock:
+            self.sock.sendall(HEADER.pack(OP_TYPES, 0))
+            (size,) = COUNT.unpack(_recv_exact(self.sock, COUNT.size))
+            return json.loads(_recv_exact(self.sock, size).decode("utf-8"))
+
+    def lookup_batch(self, latlons):
+        """
+        latlons: (N, 2) array-like of (lat, lon).
+        Returns (limits float32 array, list of road types).
+        """
+        fixes = np.ascontiguousarray(latlons, dtype="<f8").reshape(-1, 2)
+        count = len(fixes)
+        with self._lock:
+            self.sock.sendall(HEADER.pack(OP_LOOKUP, count) + fixes.tobytes())
+            (got,) = COUNT.unpack(_recv_exact(self.sock, COUNT.size))
+            body = _recv_exact(self.sock, 6 * got) if got else b""
+        limits = np.frombuffer(body, dtype="<f4", count=got)
+        type_ids = np.frombuffer(body, dtype="<u2", count=got, offset=4 * got)
+        return limits, [self.road_types[i] for i in type_ids]
+
+    def get_speed_limit(self, lat, lon):
+        limits, road_types = self.lookup_batch([(lat, lon)])
+        return float(limits[0]), road_types[0]
+
+    def close(self):
+        self.sock.close()
+
+
+# ---------------------------------------------------------
+# BENCHMARK
+# ---------------------------------------------------------
+def _bench_client(socket_path, batch, seconds, center, spread, results):
+    client = SpeedLimitClient(socket_path)
+    rng = np.random.default_rng(os.getpid())
+    fixes = center + rng.uniform(-spread, spread, size=(batch, 2))
+
+    done = 0
+    latencies = []
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        t = time.perf_counter()
+        client.lookup_batch(fixes)
+        latencies.append(time.perf_counter() - t)
+        done += batch
+    client.close()
+    results.put((done, float(np.mean(latencies))))
+
+
+def benchmark(socket_path=DEFAULT_SOCKET, clients=(1, 2, 4, 8), batch=256,
+              seconds=3.0, center=(36.80, 10.18), spread=0.1):
+    """Throughput of the service under concurrent client processes."""
+    ctx = mp.get_context("fork")
+    print(f"{'clients':>7} {'batch':>6} {'fixes/s':>12} {'ms/batch':>9}")
+    rows = []
+    for n_clients in clients:
+        results = ctx.Queue()
+        procs = [ctx.Process(target=_bench_client,
+                             args=(socket_path, batch, seconds, np.array(center),
+                                   spread, results))
+                 for _ in range(n_clients)]
+        for p in procs:
+            p.start()
+        stats = [results.get() for _ in procs]
+        for p in procs:
+            p.join()
+
+        fixes_per_s = sum(done for done, _ in stats) / seconds
+        ms_per_batch = 1000 * float(np.mean([lat for _, lat in stats]))
+        rows.append((n_clients, fixes_per_s, ms_per_batch))
+        print(f"{n_clients:>7} {batch:>6} {fixes_per_s:>12,.0f} {ms_per_batch:>9.2f}")
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shared speed-limit lookup service")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_serve = sub.add_parser("serve")
+    p_serve.add_argument("--socket", default=DEFAULT_SOCKET)
+    p_serve.add_argument("--workers", type=int, default=4)
+
+    p_bench = sub.add_parser("bench")
+    p_bench.add_argument("--socket", default=DEFAULT_SOCKET)
+    p_bench.add_argument("--clients", type=int, nargs="+", default=[1, 2, 4, 8])
+    p_bench.add_argument("--batch", type=int, default=256)
+    p_bench.add_argument("--seconds", type=float, default=3.0)
+
+    args = parser.parse_args()
+    if args.cmd == "serve":
+        serve(args.socket, args.workers)
+    else:
+        benchmark(args.socket, tuple(args.clients), args.batch, args.seconds)
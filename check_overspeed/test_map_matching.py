@@ -0,0 +1,125 @@
+import json
+import os
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import LineString
+
+# Import without the OSM extract: an empty tile directory is enough
+_tile_dir = tempfile.mkdtemp()
+with open(os.path.join(_tile_dir, "tiles.json"), "w") as f:
+    json.dump({"tile_deg": 0.1, "tiles": []}, f)
+os.environ["ROAD_TILE_DIR"] = _tile_dir
+os.environ.pop("SPEED_LIMIT_SOCKET", None)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from check_overspeed import (MapMatcher, OverspeedEpisodeBuilder, RoadIndex, TiledRoadIndex,  # noqa: E402
+                             build_tiles, match_trip)
+
+PRIMARY, SERVICE = 0, 1
+
+
+def make_index():
+    """A primary road along lat 36.80 and a service road 20 m north of it."""
+    lons = np.arange(10.0, 10.02, 0.0002)
+    roads = pd.DataFrame({
+        "geometry": [LineString([(x, 36.80) for x in lons]),
+                     LineString([(x, 36.80018) for x in lons])],
+        "highway": ["primary", "service"],
+        "maxspeed": [90, 30],
+    })
+    return RoadIndex(roads)
+
+
+def drive(n, lon0=10.001, step=0.0002, lat=36.80):
+    return [(lat, lon0 + i * step) for i in range(n)]
+
+
+def test_match_trip_keeps_fixes_before_a_gap():
+    index = make_index()
+    fixes = drive(8) + [(36.9, 10.5)] + drive(8, lon0=10.01)
+
+    matched = match_trip(fixes, index=index)
+
+    assert len(matched) == len(fixes)
+    assert matched[8] is None
+    assert matched[:8] == [PRIMARY] * 8
+    assert matched[9:] == [PRIMARY] * 8
+
+
+def test_update_does_not_reset_the_chain():
+    matcher = MapMatcher(index=make_index(), window=None)
+    for lat, lon in drive(5):
+        matcher.update(lat, lon)
+
+    assert matcher.update(36.9, 10.5) is None
+    assert matcher.best_path() == [PRIMARY] * 5
+
+
+def test_online_answer_does_not_flicker_on_one_noisy_fix():
+    fixes = drive(12)
+    fixes[6] = (36.80020, fixes[6][1])     # one fix right on the service road
+    # Cheap road switches, so the raw per-fix argmin does jump to it
+    kwargs = dict(index=make_index(), switch_cost=0.1, jump_cost=0.1)
+
+    raw = MapMatcher(lag=1, **kwargs)
+    assert [raw.update(lat, lon) for lat, lon in fixes][6] == SERVICE
+
+    matcher = MapMatcher(lag=3, **kwargs)
+    assert [matcher.update(lat, lon) for lat, lon in fixes] == [PRIMARY] * len(fixes)
+
+
+def test_online_answer_follows_a_real_road_change():
+    fixes = drive(6) + drive(8, lon0=10.0022, lat=36.80018)
+    matcher = MapMatcher(index=make_index(), switch_cost=0.1, jump_cost=0.1, lag=3)
+    online = [matcher.update(lat, lon) for lat, lon in fixes]
+
+    assert online[:6] == [PRIMARY] * 6
+    assert online[-1] == SERVICE
+
+
+def test_socket_mode_without_index_fails_clearly(monkeypatch):
+    import check_overspeed
+    from check_overspeed import LookupSessions, VehicleLookupSession
+    monkeypatch.setattr(check_overspeed, "spatial_index", None)
+
+    for cls in (MapMatcher, VehicleLookupSession, LookupSessions):
+        with pytest.raises(RuntimeError, match="needs a road index"):
+            cls()
+    # An explicit index still works
+    assert MapMatcher(index=make_index()).update(36.80, 10.001) == PRIMARY
+
+
+def test_tiled_speed_limit_reloads_an_evicted_tile(tmp_path):
+    roads = pd.DataFrame({
+        "geometry": [LineString([(10.01, 36.81), (10.02, 36.81)]),     # tile (368, 100)
+                     LineString([(10.21, 36.81), (10.22, 36.81)])],    # tile (368, 102)
+        "highway": ["primary", "residential"],
+        "maxspeed": [90, 30],
+    })
+    build_tiles(roads, str(tmp_path), tile_deg=0.1)
+    index = TiledRoadIndex(str(tmp_path), max_bytes=1, prefetch=False)   # one tile at a time
+
+    assert index.nearest_road(36.81, 10.015)[1] == 0
+    assert index.nearest_road(36.81, 10.215)[1] == 1
+    assert index.evictions == 1
+
+    assert index.speed_limit(0) == (90, "primary")
+    assert index.speed_limit(1) == (30, "residential")
+
+
+def test_episode_counts_fixes_in_the_hysteresis_band():
+    builder = OverspeedEpisodeBuilder(min_duration_s=0.0, exit_hold_s=3.0, exit_margin_kmh=5.0)
+    # Limit 60: 72 km/h is over the exit margin, 62 km/h is in the band
+    speeds = [72, 72, 62, 62, 72, 62, 62, 62, 62]
+    episodes = [builder.update({"speed": speed, "limit": 60, "status": "OVER_SPEED"}, float(t))
+                for t, speed in enumerate(speeds)]
+    assert episodes[:-1] == [None] * 8
+    episode = episodes[-1]
+    assert episode["end"] == 8.0 and episode["duration_s"] == 8.0
+    expected_m = sum((a + b) / 2 / 3.6 for a, b in zip(speeds, speeds[1:]))
+    assert episode["distance_m"] == pytest.approx(expected_m, abs=0.1)
+    assert episode["fixes"] == 3
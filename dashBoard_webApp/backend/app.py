@@ -1,34 +1,28 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit
-import json
-import os
 from datetime import datetime
+import os
 import uuid
+from storage import open_store
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
-socketio = SocketIO(app, cors_allowed_origins="*")
-
-# Database file path
-DB_FILE = 'db.json'
+# Plain threads, not eventlet: the store's append() blocks on a
+# threading.Event until its group commit, which would stall an eventlet hub
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
 
-def init_db():
-    """Initialize database file if it doesn't exist"""
-    if not os.path.exists(DB_FILE):
-        with open(DB_FILE, 'w') as f:
-            json.dump({'data': []}, f)
+# Storage backend (storage.py): SQLite in WAL mode by default, DB_BACKEND=json
+# for the old db.json file. An existing db.json is imported on first start.
+store = open_store()
 
 def read_db():
     """Read data from database"""
-    init_db()
-    with open(DB_FILE, 'r') as f:
-        return json.load(f)
+    return {'data': store.entries()}
 
-def write_db(data):
-    """Write data to database"""
-    with open(DB_FILE, 'w') as f:
-        json.dump(data, f, indent=2)
+def add_entry(entry):
+    """Append one entry (O(1), group-committed by the store's writer thread)"""
+    return store.append(entry)
 
 def _parse_timestamp(value):
     """Safely parse ISO timestamps"""
@@ -47,15 +41,10 @@ def _risk_from_score(score):
 
 def calculate_safety_score():
     """Compute latest safety score from database"""
-    db_data = read_db()
-    entries = db_data.get('data', [])
-
     latest_summary = None
-    for entry in entries:
-        values = entry.get('values', {})
-        if isinstance(values, dict) and 'safety_score' in values:
-            if latest_summary is None or _parse_timestamp(entry.get('timestamp')) > _parse_timestamp(latest_summary.get('timestamp')):
-                latest_summary = entry
+    for entry in store.entries_with_value('safety_score'):
+        if latest_summary is None or _parse_timestamp(entry.get('timestamp')) > _parse_timestamp(latest_summary.get('timestamp')):
+            latest_summary = entry
 
     if latest_summary:
         raw_score = latest_summary.get('values', {}).get('safety_score', 0)
@@ -63,7 +52,7 @@ def calculate_safety_score():
         risk = latest_summary.get('values', {}).get('risk_category') or _risk_from_score(score)
         last_updated = latest_summary.get('timestamp')
     else:
-        incident_count = sum(1 for entry in entries if entry.get('type') == 'incident')
+        incident_count = store.count('incident')
         score = max(0, 100 - incident_count)
         risk = _risk_from_score(score)
         last_updated = datetime.now().isoformat()
@@ -93,9 +82,6 @@ def create_data():
         if not data or 'deviceId' not in data or 'type' not in data:
             return jsonify({'error': 'Missing required fields: deviceId and type'}), 400
         
-        # Read existing data
-        db_data = read_db()
-        
         # Create new entry
         entry = {
             'id': str(uuid.uuid4()),
@@ -106,8 +92,7 @@ def create_data():
         }
         
         # Add to database
-        db_data['data'].append(entry)
-        write_db(db_data)
+        add_entry(entry)
         
         # Emit real-time update via Socket.IO
         socketio.emit('driverUpdate', {
@@ -124,8 +109,7 @@ def create_data():
 def get_data():
     """Get all data entries"""
     try:
-        db_data = read_db()
-        return jsonify(db_data['data'])
+        return jsonify(store.entries())
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -133,13 +117,9 @@ def get_data():
 def get_stats():
     """Get aggregated statistics"""
     try:
-        db_data = read_db()
-        entries = db_data['data']
-        
         # Filter by type if provided
         sensor_type = request.args.get('type')
-        if sensor_type:
-            entries = [e for e in entries if e.get('type') == sensor_type]
+        entries = store.entries(sensor_type or None)
         
         if not entries:
             return jsonify({'count': 0, 'averages': {}})
@@ -213,9 +193,7 @@ def handle_sensor_data(data):
         }
         
         # Save to database
-        db_data = read_db()
-        db_data['data'].append(entry)
-        write_db(db_data)
+        add_entry(entry)
         
         # Broadcast to all connected clients
         socketio.emit('driverUpdate', {
@@ -236,10 +214,11 @@ def handle_warning(data):
     print(f'Warning sent: {warning}')
 
 if __name__ == '__main__':
-    # Initialize database
-    init_db()
-    
     # Run the app
     print('Starting Flask server on http://localhost:5000')
-    socketio.run(app, host='0.0.0.0', port=5000, debug=True)
+    # Werkzeug serves the threading mode; allow it outside a terminal too
+    # (Docker, systemd, nohup). FLASK_DEBUG=1 turns on the debugger/reloader.
+    socketio.run(app, host='0.0.0.0', port=5000,
+                 debug=os.environ.get('FLASK_DEBUG') == '1',
+                 allow_unsafe_werkzeug=True)
 
@@ -0,0 +1,324 @@
+"""
+Storage backends for the dashboard entries.
+
+SQLiteStore (default) keeps entries in db.sqlite3 in WAL mode: inserts are
+O(1), every insert goes through one writer thread that commits whatever has
+queued up in a single transaction (group commit), and readers never block
+the writer. JsonFileStore is the old db.json file, kept for compatibility.
+
+    DB_BACKEND=sqlite|json   DB_PATH=db.sqlite3 (or db.json)
+    python storage.py migrate db.json db.sqlite3
+    python storage.py bench
+"""
+import os
+import sys
+import json
+import time
+import queue
+import sqlite3
+import threading
+import uuid
+
+LEGACY_DB_FILE = 'db.json'
+DEFAULT_SQLITE_PATH = 'db.sqlite3'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    seq       INTEGER PRIMARY KEY AUTOINCREMENT,
+    id        TEXT NOT NULL UNIQUE,
+    device_id TEXT,
+    timestamp TEXT,
+    type      TEXT,
+    data      TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_type ON entries(type);
+"""
+
+
+def _entry_row(entry):
+    # `data` is the whole entry as stored; the other columns are indexed copies
+    return (entry['id'], entry.get('deviceId'), entry.get('timestamp'), entry.get('type'),
+            json.dumps(entry))
+
+
+def _row_entry(row):
+    return json.loads(row[0])
+
+
+class _Pending:
+    """An insert waiting for its group commit."""
+    __slots__ = ('done', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+
+class SQLiteStore:
+    """Entries in SQLite (WAL), written by a single group-committing thread."""
+
+    def __init__(self, path=DEFAULT_SQLITE_PATH, batch_max=512, synchronous='NORMAL'):
+        self.path = path
+        self.batch_max = batch_max
+        self.synchronous = synchronous
+        self.commits = 0
+        self.committed = 0
+        self._error = None      # first failed commit of rows nobody waits for
+        self._local = threading.local()
+        self._queue = queue.Queue()
+
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        self._writer = threading.Thread(target=self._write_loop, args=(conn,), daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        # NORMAL: a WAL commit survives a crash of the app, not of the OS
+        conn.execute(f'PRAGMA synchronous={self.synchronous}')
+        conn.execute('PRAGMA busy_timeout=5000')
+        return conn
+
+    def _reader(self):
+        """One read connection per thread (WAL readers run alongside the writer)."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    # ---------- writes ----------
+    def append(self, entry, wait=True):
+        """Queue one entry; with wait=True, return once it is committed."""
+        pending = _Pending() if wait else None
+        self._queue.put((_entry_row(entry), pending))
+        if pending is not None:
+            pending.done.wait()
+            if pending.error is not None:
+                raise pending.error
+        return entry
+
+    def _write_loop(self, conn):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_max and batch[-1] is not None:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1] is None
+            if stop:
+                batch.pop()
+            if batch:
+                self._commit(conn, batch)
+            if stop:
+                conn.close()
+                return
+
+    def _commit(self, conn, batch):
+        rows = [row for row, _ in batch if row is not None]
+        error = None
+        try:
+            if rows:
+                conn.execute('BEGIN')
+                conn.executemany('INSERT OR IGNORE INTO entries (id, device_id, timestamp, type, data) '
+                                 'VALUES (?, ?, ?, ?, ?)', rows)
+                conn.execute('COMMIT')
+                self.commits += 1
+                self.committed += len(rows)
+        except Exception as e:
+            error = e
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            # append(wait=False) callers only learn about it from flush()
+            if self._error is None and any(p is None for row, p in batch if row is not None):
+                self._error = e
+        for _, pending in batch:
+            if pending is not None:
+                pending.error = error
+                pending.done.set()
+
+    def flush(self):
+        """
+        Wait until everything queued so far is committed. Raises the first
+        error of a commit since the last flush, if any.
+        """
+        # A row-less item: the writer signals it once all earlier rows are in
+        pending = _Pending()
+        self._queue.put((None, pending))
+        pending.done.wait()
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    # ---------- reads ----------
+    def entries(self, entry_type=None):
+        """All entries in insertion order, optionally of one type."""
+        sql = 'SELECT data FROM entries'
+        args = ()
+        if entry_type is not None:
+            sql += ' WHERE type = ?'
+            args = (entry_type,)
+        return [_row_entry(row) for row in self._reader().execute(sql + ' ORDER BY seq', args)]
+
+    def entries_with_value(self, key):
+        """Entries whose values object has `key`."""
+        rows = self._reader().execute(
+            'SELECT data FROM entries '
+            "WHERE json_type(data, '$.values.' || json_quote(?)) IS NOT NULL ORDER BY seq", (key,))
+        return [_row_entry(row) for row in rows]
+
+    def count(self, entry_type=None):
+        if entry_type is None:
+            return self._reader().execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+        return self._reader().execute('SELECT COUNT(*) FROM entries WHERE type = ?',
+                                      (entry_type,)).fetchone()[0]
+
+    def close(self):
+        self._queue.put(None)
+        self._writer.join()
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class JsonFileStore:
+    """The original db.json file: every append rewrites it (now under a lock)."""
+
+    def __init__(self, path=LEGACY_DB_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        if not os.path.exists(path):
+            self._write({'data': []})
+
+    def _read(self):
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    def _write(self, data):
+        with open(self.path, 'w') as f:
+            json.dump(data, f, indent=2)
+
+    def append(self, entry, wait=True):
+        with self._lock:
+            data = self._read()
+            data['data'].append(entry)
+            self._write(data)
+        return entry
+
+    def flush(self):
+        pass
+
+    def entries(self, entry_type=None):
+        with self._lock:
+            entries = self._read()['data']
+        if entry_type is not None:
+            entries = [e for e in entries if e.get('type') == entry_type]
+        return entries
+
+    def entries_with_value(self, key):
+        return [e for e in self.entries()
+                if isinstance(e.get('values', {}), dict) and key in e.get('values', {})]
+
+    def count(self, entry_type=None):
+        return len(self.entries(entry_type))
+
+    def close(self):
+        pass
+
+
+# ---------------------------------------------------------
+# MIGRATION
+# ---------------------------------------------------------
+def migrate_json(json_path, store, rename=True):
+    """
+    Copy every entry of a db.json file into `store` (entries already there,
+    by id, are skipped), then rename the file to <json_path>.migrated.
+    If any insert fails the error is raised and the file is left in place.
+    Returns the number of entries actually inserted.
+    """
+    with open(json_path, 'r') as f:
+        entries = json.load(f).get('data', [])
+    before = store.count()
+    for entry in entries:
+        if 'id' not in entry:
+            entry = {**entry, 'id': str(uuid.uuid4())}
+        store.append(entry, wait=False)
+    store.flush()
+    inserted = store.count() - before
+    if rename:
+        os.replace(json_path, json_path + '.migrated')
+    print(f'Migrated {inserted} entries from {json_path} '
+          f'({len(entries) - inserted} already present)')
+    return inserted
+
+
+def open_store(backend=None, path=None):
+    """
+    Store selected by DB_BACKEND (sqlite by default). A SQLite store that is
+    still empty imports an existing db.json (next to DB_PATH) first.
+    """
+    backend = backend or os.environ.get('DB_BACKEND', 'sqlite')
+    path = path or os.environ.get('DB_PATH')
+    if backend == 'json':
+        return JsonFileStore(path or LEGACY_DB_FILE)
+    if backend != 'sqlite':
+        raise ValueError(f'unknown DB_BACKEND: {backend}')
+    path = path or DEFAULT_SQLITE_PATH
+    store = SQLiteStore(path)
+    legacy = os.path.join(os.path.dirname(path), LEGACY_DB_FILE)
+    if os.path.exists(legacy) and store.count() == 0:
+        migrate_json(legacy, store)
+    return store
+
+
+# ---------------------------------------------------------
+# BENCHMARK
+# ---------------------------------------------------------
+def benchmark(history=(0, 1_000, 10_000), inserts=200, threads=8, workdir='.bench_storage'):
+    """Inserts/s of each backend with `history` entries already stored, from `threads` writers."""
+    os.makedirs(workdir, exist_ok=True)
+    print(f"{'backend':>8} {'history':>8} {'inserts/s':>10} {'commits':>8}")
+    for backend in ('json', 'sqlite'):
+        for n in history:
+            path = os.path.join(workdir, f'bench.{backend}')
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+            store = JsonFileStore(path) if backend == 'json' else SQLiteStore(path)
+            make = lambda i: {'id': str(uuid.uuid4()), 'deviceId': 'bench', 'type': 'sensor',
+                              'timestamp': '2024-01-01T00:00:00', 'values': {'speed': i, 'hr': 70}}
+            if backend == 'json':
+                store._write({'data': [make(i) for i in range(n)]})
+            else:
+                for i in range(n):
+                    store.append(make(i), wait=False)
+                store.flush()
+            commits_before = getattr(store, 'commits', 0)
+
+            per_thread = inserts // threads
+            writers = [threading.Thread(target=lambda: [store.append(make(i)) for i in range(per_thread)])
+                       for _ in range(threads)]
+            t0 = time.perf_counter()
+            for w in writers:
+                w.start()
+            for w in writers:
+                w.join()
+            rate = per_thread * threads / (time.perf_counter() - t0)
+            commits = getattr(store, 'commits', 0) - commits_before
+            print(f"{backend:>8} {n:>8} {rate:>10,.0f} {commits if backend == 'sqlite' else '-':>8}")
+            store.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == 'migrate':
+        json_path = sys.argv[2] if len(sys.argv) > 2 else LEGACY_DB_FILE
+        db_path = sys.argv[3] if len(sys.argv) > 3 else DEFAULT_SQLITE_PATH
+        store = SQLiteStore(db_path)
+        migrate_json(json_path, store)
+        store.close()
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'bench':
+        benchmark()
+    else:
+        print(__doc__)
@@ -7,6 +7,15 @@ import json
 import csv
 from datetime import datetime
 import os
+import sys
+import math
+import queue
+import threading
+import importlib.util
+
+# The emotion model lives in ../emotion detector (imported lazily by module 5)
+EMOTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'emotion detector')
+EMOTION_CHECKPOINT = os.path.join(EMOTION_DIR, "best_image_model.pth")
 
 # ============================================
 # LOGGER CLASS FOR STORING DETECTION DATA
@@ -43,7 +52,9 @@ class DriverLogger:
             'yawn_duration': 0.0,
             'critical_alerts': 0,
             'danger_alerts': 0,
-            'warning_alerts': 0
+            'warning_alerts': 0,
+            'emotion_alert_count': 0,
+            'emotion_alert_duration': 0.0
         }
         
         # State tracking
@@ -51,7 +62,8 @@ class DriverLogger:
             'microsleep': False,
             'distracted': False,
             'phone_usage': False,
-            'yawning': False
+            'yawning': False,
+            'emotion_alert': False
         }
         self.state_start_times = {}
         
@@ -68,12 +80,14 @@ class DriverLogger:
             writer.writerow([
                 'timestamp', 'frame_number', 'risk_level', 'eye_state', 'ear_value',
                 'head_state', 'yaw_angle', 'pitch_angle', 'phone_state', 'phone_confidence',
-                'mouth_state', 'mar_value', 'alerts'
+                'mouth_state', 'mar_value', 'emotion_state', 'emotion_confidence', 'alerts'
             ])
     
-    def log_frame(self, frame_number, analysis, eye_data, head_data, phone_data, mouth_data):
+    def log_frame(self, frame_number, analysis, eye_data, head_data, phone_data, mouth_data, emotion_data=None):
         """Log a single frame's detection data"""
         timestamp = datetime.now().isoformat()
+        if emotion_data is None:
+            emotion_data = {'state': 'OFF', 'confidence': 0.0, 'is_alert': False}
         
         log_entry = {
             'timestamp': timestamp,
@@ -88,6 +102,8 @@ class DriverLogger:
             'phone_confidence': round(phone_data['confidence'], 2),
             'mouth_state': mouth_data['state'],
             'mar_value': round(mouth_data['mar'], 3),
+            'emotion_state': emotion_data['state'],
+            'emotion_confidence': round(emotion_data['confidence'], 3),
             'alerts': analysis['alerts']
         }
         
@@ -100,13 +116,14 @@ class DriverLogger:
                 timestamp, frame_number, analysis['risk_level'], eye_data['state'], eye_data['ear'],
                 head_data['state'], head_data['yaw'], head_data['pitch'], phone_data['state'],
                 phone_data['confidence'], mouth_data['state'], mouth_data['mar'],
+                emotion_data['state'], emotion_data['confidence'],
                 '; '.join(analysis['alerts'])
             ])
         
-        self._update_statistics(analysis, eye_data, head_data, phone_data, mouth_data)
+        self._update_statistics(analysis, eye_data, head_data, phone_data, mouth_data, emotion_data)
         self.statistics['total_frames'] += 1
     
-    def _update_statistics(self, analysis, eye_data, head_data, phone_data, mouth_data):
+    def _update_statistics(self, analysis, eye_data, head_data, phone_data, mouth_data, emotion_data):
         """Update running statistics"""
         current_time = time.time()
         
@@ -164,6 +181,18 @@ class DriverLogger:
                 duration = current_time - self.state_start_times['yawning']
                 self.statistics['yawn_duration'] += duration
             self.last_states['yawning'] = False
+        
+        # Track sleepy / drunk / angry expressions
+        if emotion_data['is_alert']:
+            if not self.last_states['emotion_alert']:
+                self.statistics['emotion_alert_count'] += 1
+                self.state_start_times['emotion_alert'] = current_time
+            self.last_states['emotion_alert'] = True
+        else:
+            if self.last_states['emotion_alert']:
+                duration = current_time - self.state_start_times['emotion_alert']
+                self.statistics['emotion_alert_duration'] += duration
+            self.last_states['emotion_alert'] = False
     
     def save_session(self):
         """Save complete session data"""
@@ -215,7 +244,9 @@ class DriverLogger:
             f.write(f"Phone Usage Events: {self.statistics['phone_usage_count']} "
                    f"(Total: {self.statistics['phone_usage_duration']:.1f}s)\n")
             f.write(f"Yawn Events: {self.statistics['yawn_count']} "
-                   f"(Total: {self.statistics['yawn_duration']:.1f}s)\n\n")
+                   f"(Total: {self.statistics['yawn_duration']:.1f}s)\n")
+            f.write(f"Sleepy/Drunk/Angry Expression Events: {self.statistics['emotion_alert_count']} "
+                   f"(Total: {self.statistics['emotion_alert_duration']:.1f}s)\n\n")
             
             safety_score = self._calculate_safety_score(session_duration)
             f.write("SAFETY SCORE\n")
@@ -263,6 +294,7 @@ class DriverLogger:
         print(f"Distraction Events: {self.statistics['distraction_count']}")
         print(f"Phone Usage Events: {self.statistics['phone_usage_count']}")
         print(f"Yawn Events: {self.statistics['yawn_count']}")
+        print(f"Expression Alerts: {self.statistics['emotion_alert_count']}")
         print("=" * 50 + "\n")
 
 # ============================================
@@ -285,6 +317,7 @@ class EyeStateDetector:
         self.closed_frames = 0
         self.eyes_state = "OPEN"
         self.eyes_closed_start = None
+        self.landmarks = None   # last frame's face landmarks, reused by module 5
         
     def calculate_ear(self, eye_points):
         A = dist.euclidean(eye_points[1], eye_points[5])
@@ -298,9 +331,11 @@ class EyeStateDetector:
         results = self.face_mesh.process(rgb_frame)
         
         eye_data = {'state': 'NO_FACE', 'ear': 0.0, 'closed_duration': 0.0, 'is_microsleep': False}
+        self.landmarks = None
         
         if results.multi_face_landmarks:
             landmarks = results.multi_face_landmarks[0].landmark
+            self.landmarks = landmarks
             left_eye = [(int(landmarks[i].x * width), int(landmarks[i].y * height)) for i in self.LEFT_EYE_INDICES]
             right_eye = [(int(landmarks[i].x * width), int(landmarks[i].y * height)) for i in self.RIGHT_EYE_INDICES]
             
@@ -566,11 +601,166 @@ class MouthStateDetector:
         
         return mouth_data
 
+# ============================================
+# MODULE 5: EMOTION STATE CLASSIFIER (ASYNC)
+# ============================================
+class EmotionStateDetector:
+    """
+    Runs the emotion model from ../emotion detector on a worker thread at
+    RATE_HZ. The frame loop only crops the face (from the eye detector's
+    landmarks) and reads the latest smoothed probabilities, so it never
+    waits for the model.
+    """
+    def __init__(self, rate_hz=2.0, smoothing_s=3.0, edge_model="edge_cnn48.pth"):
+        self.RATE_HZ = rate_hz
+        self.SMOOTHING_S = smoothing_s          # EMA time constant of the probabilities
+        self.STALE_S = 2 * smoothing_s          # no result for this long -> no state
+        self.FACE_SIZE = 48
+        self.FACE_MARGIN = 0.2
+        # label -> (smoothed probability that raises an alert, risk level)
+        self.ALERT_PROBS = {'sleepy': (0.6, 'WARNING'), 'drunk': (0.6, 'DANGER'), 'angry': (0.7, 'WARNING')}
+        self.edge_model_path = os.path.join(EMOTION_DIR, edge_model)
+        
+        self.labels = None
+        self.available = True
+        self.smoothed = None
+        self.last_result_time = None
+        self.last_submit = 0.0
+        self.frame_cost_ms = 0.0                # EMA of the time detect() adds to a frame
+        self.infer_ms = 0.0                     # EMA of one classification on the worker
+        self.classified = 0
+        self.dropped = 0
+        
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=1)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+    
+    @staticmethod
+    def missing_requirement(edge_model="edge_cnn48.pth"):
+        """Why the module cannot run here (no PyTorch, no checkpoint), or None."""
+        if importlib.util.find_spec("torch") is None:
+            return "PyTorch is not installed"
+        if not (os.path.exists(os.path.join(EMOTION_DIR, edge_model)) or
+                os.path.exists(EMOTION_CHECKPOINT)):
+            return f"no {edge_model} or best_image_model.pth in {os.path.normpath(EMOTION_DIR)}"
+        return None
+    
+    def _load_model(self):
+        """Distilled edge model if one was trained, else the ResNet-50 (inference_img)."""
+        if EMOTION_DIR not in sys.path:
+            sys.path.append(EMOTION_DIR)
+        import inference_img
+        if os.path.exists(self.edge_model_path):
+            import torch
+            from edge_model import load_edge_model, edge_preprocess
+            model = load_edge_model(self.edge_model_path)
+            n = model.num_classes
+            def classify(face):
+                with torch.inference_mode():
+                    logits = model(edge_preprocess(face[None], model.input_size))
+                return torch.softmax(logits, dim=1)[0].numpy()
+            print(f"✓ Emotion model: {os.path.basename(self.edge_model_path)}")
+        else:
+            n = inference_img.num_classes
+            classify = lambda face: inference_img.predict_batch([face], model_path=EMOTION_CHECKPOINT)[0]
+            print("✓ Emotion model: ResNet-50 (best_image_model.pth)")
+        self.labels = [inference_img.label_map.get(i, str(i)) for i in range(n)]
+        return classify
+    
+    def _worker(self):
+        try:
+            classify = self._load_model()
+        except Exception as e:
+            self.available = False
+            print(f"○ Emotion classification disabled ({e})")
+            return
+        while not self._stop.is_set():
+            try:
+                face, t = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            t0 = time.perf_counter()
+            probs = classify(face)
+            ms = (time.perf_counter() - t0) * 1000
+            self.infer_ms = 0.9 * self.infer_ms + 0.1 * ms if self.classified else ms
+            with self._lock:
+                if self.smoothed is None or t - self.last_result_time > self.STALE_S:
+                    self.smoothed = probs
+                else:
+                    alpha = 1.0 - math.exp(-(t - self.last_result_time) / self.SMOOTHING_S)
+                    self.smoothed = alpha * probs + (1.0 - alpha) * self.smoothed
+                self.last_result_time = t
+                self.classified += 1
+    
+    def crop_face(self, frame, landmarks):
+        """Square grayscale FACE_SIZE crop around the landmarks, or None."""
+        height, width, _ = frame.shape
+        xs = [lm.x for lm in landmarks]
+        ys = [lm.y for lm in landmarks]
+        cx, cy = (min(xs) + max(xs)) / 2 * width, (min(ys) + max(ys)) / 2 * height
+        half = max((max(xs) - min(xs)) * width, (max(ys) - min(ys)) * height) * (1 + self.FACE_MARGIN) / 2
+        x1, y1 = max(0, int(cx - half)), max(0, int(cy - half))
+        x2, y2 = min(width, int(cx + half)), min(height, int(cy + half))
+        if x2 - x1 < 16 or y2 - y1 < 16:
+            return None
+        gray = cv2.cvtColor(frame[y1:y2, x1:x2], cv2.COLOR_BGR2GRAY)
+        return cv2.resize(gray, (self.FACE_SIZE, self.FACE_SIZE), interpolation=cv2.INTER_AREA)
+    
+    def detect(self, frame, landmarks):
+        t0 = time.perf_counter()
+        now = time.time()
+        
+        if self.available and landmarks is not None and now - self.last_submit >= 1.0 / self.RATE_HZ:
+            face = self.crop_face(frame, landmarks)
+            if face is not None:
+                # Keep only the newest face: drop one the worker has not started on
+                try:
+                    self._queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+                self._queue.put_nowait((face, now))
+                self.last_submit = now
+        
+        emotion_data = {'state': 'NO_FACE', 'confidence': 0.0, 'probs': {}, 'is_alert': False,
+                        'alert_label': None, 'age_s': None}
+        if not self.available:
+            emotion_data['state'] = 'OFF'
+        else:
+            with self._lock:
+                smoothed, last = self.smoothed, self.last_result_time
+            if smoothed is not None and now - last <= self.STALE_S:
+                best = int(np.argmax(smoothed))
+                emotion_data['state'] = self.labels[best]
+                emotion_data['confidence'] = float(smoothed[best])
+                emotion_data['probs'] = {label: float(p) for label, p in zip(self.labels, smoothed)}
+                emotion_data['age_s'] = now - last
+                for label, (threshold, _) in self.ALERT_PROBS.items():
+                    if emotion_data['probs'].get(label, 0.0) >= threshold:
+                        emotion_data['is_alert'] = True
+                        emotion_data['alert_label'] = label
+                        break
+        
+        cost_ms = (time.perf_counter() - t0) * 1000
+        self.frame_cost_ms = 0.95 * self.frame_cost_ms + 0.05 * cost_ms if self.frame_cost_ms else cost_ms
+        emotion_data['frame_cost_ms'] = self.frame_cost_ms
+        return emotion_data
+    
+    def stats(self):
+        return {'classified': self.classified, 'dropped': self.dropped,
+                'frame_cost_ms': self.frame_cost_ms, 'infer_ms': self.infer_ms}
+    
+    def close(self):
+        self._stop.set()
+        self._thread.join(timeout=2.0)
+
 # ============================================
 # COMBINED SYSTEM
 # ============================================
 class DriverMonitoringSystem:
-    def __init__(self, enable_logging=True, session_name=None):
+    def __init__(self, enable_logging=True, session_name=None, enable_emotion=True, emotion_rate_hz=2.0):
         print("Initializing Driver Monitoring System...")
         print("Loading Module 1: Eye State Detection...")
         self.eye_detector = EyeStateDetector()
@@ -588,6 +778,17 @@ class DriverMonitoringSystem:
         self.mouth_detector = MouthStateDetector()
         print("✓ Mouth detector ready")
         
+        missing = EmotionStateDetector.missing_requirement() if enable_emotion else None
+        if missing:
+            print(f"○ Module 5: Emotion Classification off ({missing})")
+            enable_emotion = False
+        if enable_emotion:
+            print(f"Loading Module 5: Emotion Classification ({emotion_rate_hz:g} Hz, background thread)...")
+            self.emotion_detector = EmotionStateDetector(rate_hz=emotion_rate_hz)
+            print("✓ Emotion detector started")
+        else:
+            self.emotion_detector = None
+        
         self.enable_logging = enable_logging
         if enable_logging:
             self.logger = DriverLogger(session_name)
@@ -595,13 +796,14 @@ class DriverMonitoringSystem:
             self.logger = None
         
         self.frame_count = 0
-        print("\n✓ All 4 modules loaded successfully!")
+        print(f"\n✓ All {5 if enable_emotion else 4} modules loaded successfully!")
         if enable_logging:
             print("✓ Logging enabled\n")
         
-    def analyze_driver_state(self, eye_data, head_data, phone_data, mouth_data):
+    def analyze_driver_state(self, eye_data, head_data, phone_data, mouth_data, emotion_data=None):
         alerts = []
         risk_level = "SAFE"
+        levels = ["SAFE", "WARNING", "DANGER", "CRITICAL"]
         
         if eye_data['is_microsleep']:
             alerts.append(f"MICROSLEEP! ({eye_data['closed_duration']:.1f}s)")
@@ -632,13 +834,21 @@ class DriverMonitoringSystem:
             if risk_level == "SAFE":
                 risk_level = "WARNING"
         
+        if emotion_data is not None and emotion_data['is_alert']:
+            label = emotion_data['alert_label']
+            alerts.append(f"{label.upper()} expression ({emotion_data['probs'][label]:.0%})")
+            _, level = self.emotion_detector.ALERT_PROBS[label]
+            if levels.index(level) > levels.index(risk_level):
+                risk_level = level
+        
         return {
             'risk_level': risk_level,
             'alerts': alerts,
             'eye_state': eye_data['state'],
             'head_state': head_data['state'],
             'phone_state': phone_data['state'],
-            'mouth_state': mouth_data['state']
+            'mouth_state': mouth_data['state'],
+            'emotion_state': emotion_data['state'] if emotion_data is not None else 'OFF'
         }
     
     def process_frame(self, frame):
@@ -649,11 +859,14 @@ class DriverMonitoringSystem:
         head_data = self.head_detector.detect(frame)
         phone_data = self.phone_detector.detect(frame)
         mouth_data = self.mouth_detector.detect(frame)
+        emotion_data = None
+        if self.emotion_detector:
+            emotion_data = self.emotion_detector.detect(frame, self.eye_detector.landmarks)
         
-        analysis = self.analyze_driver_state(eye_data, head_data, phone_data, mouth_data)
+        analysis = self.analyze_driver_state(eye_data, head_data, phone_data, mouth_data, emotion_data)
         
         if self.logger:
-            self.logger.log_frame(self.frame_count, analysis, eye_data, head_data, phone_data, mouth_data)
+            self.logger.log_frame(self.frame_count, analysis, eye_data, head_data, phone_data, mouth_data, emotion_data)
         
         colors = {'SAFE': (0, 255, 0), 'WARNING': (0, 255, 255), 'DANGER': (0, 165, 255), 'CRITICAL': (0, 0, 255)}
         risk_color = colors[analysis['risk_level']]
@@ -662,7 +875,7 @@ class DriverMonitoringSystem:
             thickness = 5 if analysis['risk_level'] == 'WARNING' else 10
             cv2.rectangle(frame, (5, 5), (width-5, height-5), risk_color, thickness)
         
-        panel_width, panel_height = 350, 180
+        panel_width, panel_height = 350, 210
         overlay = frame.copy()
         cv2.rectangle(overlay, (0, 0), (panel_width, panel_height), (0, 0, 0), -1)
         cv2.addWeighted(overlay, 0.7, frame, 0.3, 0, frame)
@@ -678,6 +891,11 @@ class DriverMonitoringSystem:
         cv2.putText(frame, f"Phone: {analysis['phone_state']}", (10, y_offset), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
         y_offset += 30
         cv2.putText(frame, f"Mouth: {analysis['mouth_state']}", (10, y_offset), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
+        y_offset += 30
+        emotion_text = analysis['emotion_state']
+        if emotion_data is not None and emotion_data['confidence'] > 0:
+            emotion_text += f" ({emotion_data['confidence']:.0%})"
+        cv2.putText(frame, f"Emotion: {emotion_text}", (10, y_offset), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
         
         if analysis['alerts']:
             alert_y = height - 30
@@ -715,6 +933,7 @@ def main():
     print("  ✓ Module 2: Head Pose Detection (Distraction detection)")
     print("  ✓ Module 3: Phone Detection (Hand + YOLO fusion)")
     print("  ✓ Module 4: Mouth State Detection (Fatigue/yawn detection)")
+    print("  ✓ Module 5: Emotion Classification (sleepy/drunk/angry, background thread)")
     print("\n📊 Risk Levels:")
     print("  🟢 SAFE      - All systems normal")
     print("  🟡 WARNING   - Minor issues detected")
@@ -773,9 +992,18 @@ def main():
         elif key == ord('p'):
             if system.logger:
                 system.logger.print_stats()
+            if system.emotion_detector:
+                es = system.emotion_detector.stats()
+                print(f"Emotion: {es['classified']} faces classified, {es['dropped']} dropped, "
+                      f"+{es['frame_cost_ms']:.2f} ms/frame, {es['infer_ms']:.1f} ms/inference (worker)")
     
     cap.release()
     cv2.destroyAllWindows()
+    if system.emotion_detector:
+        es = system.emotion_detector.stats()
+        print(f"\n🙂 Emotion module added {es['frame_cost_ms']:.2f} ms per frame "
+              f"({es['classified']} faces classified at {es['infer_ms']:.1f} ms each on the worker)")
+        system.emotion_detector.close()
     
     if system.logger:
         print("\n💾 Saving session data...")
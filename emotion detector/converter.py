@@ -1,13 +1,16 @@
 import os
+import argparse
 import pandas as pd
 import numpy as np
 from PIL import Image
+from sklearn.model_selection import train_test_split
 
-df = pd.read_csv("fer2013.csv")
-
-# Create folders
-root = "fer_images"
-os.makedirs(root, exist_ok=True)
+# Converts fer2013.csv into one uint8 (N, 48, 48) array instead of one PNG
+# per row:
+#   fer2013.npy       images, np.load(..., mmap_mode="r") maps it without reading
+#   fer2013_meta.npz  labels, class names and train/val/test indices
+# image_pipeline.load_packed() / DriverImageDataset(images=...) read it directly.
+# The PNG folders for create-labels.py are still written unless --no-png.
 
 emotion_map = {
     0: "angry",
@@ -19,18 +22,106 @@ emotion_map = {
     6: "neutral"
 }
 
-for emotion in emotion_map.values():
-    os.makedirs(os.path.join(root, emotion), exist_ok=True)
+# FER2013 "Usage" column -> split name
+usage_splits = {"Training": "train", "PublicTest": "val", "PrivateTest": "test"}
+
+
+def parse_pixels(pixel_strings, size=48, chunk_rows=4096):
+    """
+    Parse FER2013 pixel strings ("70 80 82 ...") into a uint8 (N, size, size)
+    array. Each chunk of rows is joined and parsed by NumPy's C text parser
+    in one call, straight into the output array.
+    """
+    pixel_strings = list(pixel_strings)
+    n, npx = len(pixel_strings), size * size
+    out = np.empty((n, size, size), dtype=np.uint8)
+    flat = out.reshape(-1)
+
+    for start in range(0, n, chunk_rows):
+        chunk = pixel_strings[start:start + chunk_rows]
+        values = np.fromstring(" ".join(chunk), dtype=np.uint8, sep=" ")
+        if len(values) != len(chunk) * npx:
+            raise ValueError(f"rows {start}-{start + len(chunk) - 1}: expected "
+                             f"{npx} pixels per row, got {len(values)} values in total")
+        flat[start * npx:(start + len(chunk)) * npx] = values
+    return out
+
+
+def make_splits(labels, usage=None, val_size=0.2, seed=42):
+    """Split indices from the Usage column, else a stratified train/val split."""
+    if usage is not None:
+        usage = np.asarray(usage)
+        return {name: np.flatnonzero(usage == u) for u, name in usage_splits.items()}
+    idx = np.arange(len(labels))
+    train_idx, val_idx = train_test_split(idx, test_size=val_size, stratify=labels,
+                                          random_state=seed)
+    return {"train": np.sort(train_idx), "val": np.sort(val_idx)}
+
+
+def save_packed(out, images, labels, class_names, splits):
+    """Write <out>.npy (images) and <out>_meta.npz (labels, class names, splits)."""
+    np.save(out + ".npy", images)
+    np.savez(out + "_meta.npz", labels=np.asarray(labels, dtype=np.int64),
+             class_names=np.asarray(class_names), **{f"split_{k}": v for k, v in splits.items()})
+    print(f"Saved {len(images)} images to {out}.npy ({images.nbytes / 1e6:.1f} MB) "
+          f"and {out}_meta.npz, splits: {', '.join(f'{k}={len(v)}' for k, v in splits.items())}")
+
+
+def convert_csv(csv_path="fer2013.csv", out="fer2013"):
+    df = pd.read_csv(csv_path)
+    images = parse_pixels(df["pixels"])
+    labels = df["emotion"].to_numpy()
+    class_names = [emotion_map[i] for i in range(len(emotion_map))]
+    splits = make_splits(labels, df["Usage"] if "Usage" in df else None)
+    save_packed(out, images, labels, class_names, splits)
+    return images, labels
+
+
+def pack_folder(labels_csv="labels.csv", img_dir="fer_images", out="labels", size=48):
+    """
+    Pack a filename,label CSV of image files (see create-labels.py) into the
+    same format, decoding each image once (grayscale, size x size).
+    """
+    df = pd.read_csv(labels_csv)
+    images = np.empty((len(df), size, size), dtype=np.uint8)
+    for i, fname in enumerate(df["filename"]):
+        img = Image.open(os.path.join(img_dir, fname)).convert("L")
+        if img.size != (size, size):
+            img = img.resize((size, size), Image.BILINEAR)
+        images[i] = np.asarray(img)
+    labels = df["label"].to_numpy()
+    # Class names by label id, from the folder names
+    names = df.assign(name=df["filename"].str.split("/").str[0]).groupby("label")["name"].first()
+    class_names = [names.get(i, str(i)) for i in range(int(labels.max()) + 1)]
+    save_packed(out, images, labels, class_names, make_splits(labels))
+    return images, labels
+
+
+def export_png(images, labels, root="fer_images"):
+    """The old layout: one PNG per image in fer_images/<emotion>/<i>.png."""
+    for emotion in emotion_map.values():
+        os.makedirs(os.path.join(root, emotion), exist_ok=True)
+    for i, (img, label) in enumerate(zip(images, labels)):
+        Image.fromarray(img).save(os.path.join(root, emotion_map[int(label)], f"{i}.png"))
+
 
-# Convert each row into an image
-for i, row in df.iterrows():
-    pixels = np.array(row["pixels"].split(), dtype="uint8")
-    img = pixels.reshape(48,48)  # grayscale
-    
-    # convert to PIL Image
-    img = Image.fromarray(img)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert FER2013 / image folders to .npy")
+    parser.add_argument("--csv", default="fer2013.csv")
+    parser.add_argument("--out", default="fer2013")
+    parser.add_argument("--no-png", dest="png", action="store_false",
+                        help="skip fer_images/<emotion>/<i>.png (only needed by create-labels.py)")
+    parser.add_argument("--from-labels", metavar="LABELS_CSV",
+                        help="pack the images listed in a filename,label CSV instead")
+    parser.add_argument("--img-dir", default="fer_images")
+    args = parser.parse_args()
 
-    label = emotion_map[row["emotion"]]
-    img.save(os.path.join(root, label, f"{i}.png"))
+    if args.from_labels:
+        pack_folder(args.from_labels, args.img_dir,
+                    os.path.splitext(os.path.basename(args.from_labels))[0])
+    else:
+        images, labels = convert_csv(args.csv, args.out)
+        if args.png:
+            export_png(images, labels, args.img_dir)
 
-print("Conversion complete!")
+    print("Conversion complete!")
@@ -0,0 +1,268 @@
+# edge_model.py
+# Compact CPU models for the in-cabin camera, distilled from the ResNet-50 in
+# best_image_model.pth. The ResNet-50 runs 224x224 RGB on 48x48 faces; these
+# run on the grayscale face at (close to) its native size.
+#   python edge_model.py --arch cnn48 --epochs 30     distill one student
+#   python edge_model.py --compare-only               accuracy/latency/memory table
+import os, copy, time, argparse
+import numpy as np
+import pandas as pd
+import torch
+from torch import nn, optim
+import torch.nn.functional as F
+from torchvision.models import mobilenet_v3_small, MobileNet_V3_Small_Weights
+from image_pipeline import (get_image_model, make_dataloaders, BatchAugment, load_packed,
+                            packed_dataframe, IMAGENET_MEAN, IMAGENET_STD)
+
+TARGET_MS = 10.0        # per face, batch 1, on one CPU thread
+
+# ----- 1) Student models -----
+def _dw_block(cin, cout, stride):
+    """Depthwise 3x3 + pointwise 1x1, each with BN + ReLU."""
+    return nn.Sequential(
+        nn.Conv2d(cin, cin, 3, stride, 1, groups=cin, bias=False),
+        nn.BatchNorm2d(cin),
+        nn.ReLU(inplace=True),
+        nn.Conv2d(cin, cout, 1, bias=False),
+        nn.BatchNorm2d(cout),
+        nn.ReLU(inplace=True),
+    )
+
+class SmallFaceCNN(nn.Module):
+    """Depthwise-separable CNN for 1-channel faces; 3 stride-2 stages (48 -> 6)."""
+    def __init__(self, num_classes=5, width=32, dropout=0.2):
+        super().__init__()
+        w = width
+        self.features = nn.Sequential(
+            nn.Conv2d(1, w, 3, 1, 1, bias=False),
+            nn.BatchNorm2d(w),
+            nn.ReLU(inplace=True),
+            _dw_block(w, 2 * w, 2),
+            _dw_block(2 * w, 2 * w, 1),
+            _dw_block(2 * w, 4 * w, 2),
+            _dw_block(4 * w, 4 * w, 1),
+            _dw_block(4 * w, 8 * w, 2),
+            _dw_block(8 * w, 8 * w, 1),
+        )
+        self.head = nn.Sequential(
+            nn.AdaptiveAvgPool2d(1),
+            nn.Flatten(),
+            nn.Dropout(dropout),
+            nn.Linear(8 * w, num_classes),
+        )
+
+    def forward(self, x):
+        return self.head(self.features(x))
+
+class MobileNetFace(nn.Module):
+    """MobileNetV3-Small (ImageNet weights) on a 1-channel face, repeated to RGB."""
+    def __init__(self, num_classes=5, pretrained=True):
+        super().__init__()
+        weights = MobileNet_V3_Small_Weights.IMAGENET1K_V1 if pretrained else None
+        self.net = mobilenet_v3_small(weights=weights)
+        self.net.classifier[-1] = nn.Linear(self.net.classifier[-1].in_features, num_classes)
+
+    def forward(self, x):
+        return self.net(x.expand(-1, 3, -1, -1))
+
+# name -> (builder(num_classes), input size)
+EDGE_ARCHS = {
+    "cnn48": (lambda nc: SmallFaceCNN(nc, width=32), 48),
+    "cnn64": (lambda nc: SmallFaceCNN(nc, width=48), 64),
+    "mnv3s96": (lambda nc: MobileNetFace(nc), 96),
+}
+
+def get_edge_model(arch="cnn48", num_classes=5):
+    build, size = EDGE_ARCHS[arch]
+    model = build(num_classes)
+    model.arch, model.input_size, model.num_classes = arch, size, num_classes
+    return model
+
+def load_edge_model(path, device='cpu'):
+    """Load a checkpoint written by distill()."""
+    ckpt = torch.load(path, map_location=device)
+    model = get_edge_model(ckpt["arch"], ckpt["num_classes"])
+    model.load_state_dict(ckpt["state_dict"])
+    return model.to(device).eval()
+
+# ----- 2) Preprocessing -----
+# Students see the same grayscale face the teacher sees, downsampled. Training
+# (to_student) and inference (edge_preprocess) both end in student_input(),
+# so the student is served exactly the resize and scaling it was trained on.
+def student_input(x, size):
+    """Float images in [0, 1], (N, C, H, W) -> grayscale (N, 1, size, size) in [-1, 1]."""
+    if x.shape[1] != 1: x = x.mean(1, keepdim=True)
+    x = F.interpolate(x, size=(size, size), mode='bilinear', antialias=True, align_corners=False)
+    return (x - 0.5) / 0.5
+
+def to_student(x_teacher, size):
+    """The teacher's (augmented, normalised) input -> student input."""
+    mean = torch.tensor(IMAGENET_MEAN, device=x_teacher.device).view(1, 3, 1, 1)
+    std = torch.tensor(IMAGENET_STD, device=x_teacher.device).view(1, 3, 1, 1)
+    return student_input(x_teacher * std + mean, size)
+
+def edge_preprocess(faces, size, center_frac=224/256):
+    """
+    uint8 faces (N, H, W) or (N, H, W, 3) -> float (N, 1, size, size), centre
+    cropped like val_tfms, then student_input() as in training.
+    """
+    x = torch.as_tensor(np.asarray(faces)).float().div_(255)
+    x = x[:, None] if x.dim() == 3 else x.permute(0, 3, 1, 2)
+    H, W = x.shape[-2:]
+    ch, cw = round(H * center_frac), round(W * center_frac)
+    top, left = (H - ch) // 2, (W - cw) // 2
+    return student_input(x[..., top:top + ch, left:left + cw], size)
+
+# ----- 3) Distillation -----
+def load_teacher(path="best_image_model.pth", device='cpu'):
+    """The ResNet-50 from image_pipeline; class count read from the checkpoint."""
+    state = torch.load(path, map_location=device)
+    num_classes = state["fc.4.weight"].shape[0]
+    teacher = get_image_model(num_classes=num_classes, pretrained=False)
+    teacher.load_state_dict(state)
+    for p in teacher.parameters(): p.requires_grad = False
+    return teacher.to(device).eval()
+
+def distill_loss(student_logits, teacher_logits, labels, T=4.0, alpha=0.7):
+    """Hinton KD: alpha * T^2 * KL(soft teacher || soft student) + (1 - alpha) * CE."""
+    kd = F.kl_div(F.log_softmax(student_logits / T, 1), F.softmax(teacher_logits / T, 1),
+                  reduction='batchmean') * T * T
+    return alpha * kd + (1 - alpha) * F.cross_entropy(student_logits, labels)
+
+def distill(student, teacher, train_loader, val_loader, epochs=30, lr=2e-3, T=4.0,
+            alpha=0.7, device='cpu', out_path=None):
+    """
+    Train `student` on the teacher's soft labels. Loaders yield uint8 batches
+    (make_dataloaders(tensor_aug=True)); each batch is augmented once and the
+    teacher and student see the same crop. Saves the best epoch to out_path.
+    """
+    student = student.to(device)
+    train_aug, val_aug = BatchAugment(train=True), BatchAugment(train=False)
+    optimizer = optim.AdamW(student.parameters(), lr=lr, weight_decay=1e-4)
+    scheduler = optim.lr_scheduler.OneCycleLR(optimizer, max_lr=lr, epochs=epochs,
+                                              steps_per_epoch=len(train_loader))
+    if out_path is None: out_path = f"edge_{student.arch}.pth"
+
+    best_acc = -1.0
+    for epoch in range(1, epochs + 1):
+        student.train()
+        t0, running, n = time.perf_counter(), 0.0, 0
+        for images, labels in train_loader:
+            images, labels = images.to(device), labels.to(device)
+            x = train_aug(images)
+            with torch.no_grad():
+                teacher_logits = teacher(x)
+            logits = student(to_student(x, student.input_size))
+            loss = distill_loss(logits, teacher_logits, labels, T, alpha)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            scheduler.step()
+            running += loss.item() * labels.size(0)
+            n += labels.size(0)
+        val_acc = accuracy(student, val_loader, val_aug, student.input_size, device)
+        print(f"Epoch {epoch}: loss={running / n:.4f} val_acc={val_acc:.4f} "
+              f"({time.perf_counter() - t0:.0f}s)")
+        if val_acc > best_acc:
+            best_acc = val_acc
+            torch.save({"arch": student.arch, "num_classes": student.num_classes,
+                        "state_dict": copy.deepcopy(student.state_dict())}, out_path)
+    print(f"Best val acc: {best_acc:.4f} -> {out_path}")
+    return best_acc
+
+# ----- 4) Accuracy / latency / memory -----
+def accuracy(model, loader, augment, input_size=None, device='cpu'):
+    """Top-1 on a uint8 loader; input_size=None feeds the 224 teacher input as is."""
+    model.eval()
+    correct = total = 0
+    with torch.inference_mode():
+        for images, labels in loader:
+            x = augment(images.to(device))
+            if input_size is not None: x = to_student(x, input_size)
+            correct += (model(x).argmax(1).cpu() == labels).sum().item()
+            total += labels.size(0)
+    return correct / total
+
+def measure_latency(model, input_shape, runs=200, warmup=20, threads=1):
+    """Median and p95 ms for one face (batch 1) with `threads` intra-op threads."""
+    prev = torch.get_num_threads()
+    torch.set_num_threads(threads)
+    model = copy.deepcopy(model).cpu().eval()       # leave the caller's model on its device
+    x = torch.randn(1, *input_shape)
+    times = []
+    with torch.inference_mode():
+        for i in range(warmup + runs):
+            t = time.perf_counter()
+            model(x)
+            if i >= warmup: times.append(time.perf_counter() - t)
+    torch.set_num_threads(prev)
+    return 1000 * float(np.median(times)), 1000 * float(np.percentile(times, 95))
+
+def model_memory(model, input_shape):
+    """(weights MB, activations MB): parameters + buffers, and every module output for one face."""
+    model = copy.deepcopy(model).cpu().eval()
+    weights = sum(t.numel() * t.element_size()
+                  for t in list(model.parameters()) + list(model.buffers()))
+    acts = []
+    hooks = [m.register_forward_hook(lambda m, i, o: acts.append(o.numel() * o.element_size()))
+             for m in model.modules() if not list(m.children())]
+    with torch.inference_mode():
+        model(torch.randn(1, *input_shape))
+    for h in hooks: h.remove()
+    return weights / 1e6, sum(acts) / 1e6
+
+def compare_models(models, val_loader, threads=1, device='cpu'):
+    """
+    models: {name: (model, input_size or None for the 224 RGB teacher)}.
+    Prints and returns one row per model.
+    """
+    val_aug = BatchAugment(train=False)
+    rows = []
+    print(f"{'model':>10} {'input':>9} {'params':>8} {'weights':>9} {'acts':>8} "
+          f"{'val_acc':>8} {'ms/face':>8} {'p95':>7}")
+    for name, (model, size) in models.items():
+        acc = accuracy(model.to(device), val_loader, val_aug, size, device)
+        shape = (3, 224, 224) if size is None else (1, size, size)
+        ms, p95 = measure_latency(model, shape, threads=threads)
+        weights_mb, acts_mb = model_memory(model, shape)
+        params = sum(p.numel() for p in model.parameters()) / 1e6
+        flag = "" if ms < TARGET_MS else "  > target"
+        print(f"{name:>10} {'x'.join(map(str, shape[1:])) + 'x' + str(shape[0]):>9} {params:>7.2f}M "
+              f"{weights_mb:>7.1f}MB {acts_mb:>6.1f}MB {acc:>8.4f} {ms:>8.2f} {p95:>7.2f}{flag}")
+        rows.append(dict(model=name, input=shape, params_m=params, weights_mb=weights_mb,
+                         acts_mb=acts_mb, val_acc=acc, ms=ms, p95_ms=p95))
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distill edge emotion models from the ResNet-50")
+    parser.add_argument("--arch", default="cnn48", choices=sorted(EDGE_ARCHS))
+    parser.add_argument("--teacher", default="best_image_model.pth")
+    parser.add_argument("--epochs", type=int, default=30)
+    parser.add_argument("--lr", type=float, default=2e-3)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=1, help="CPU threads for the latency column")
+    parser.add_argument("--compare-only", action="store_true",
+                        help="only print the table for the teacher and existing edge_*.pth")
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if os.path.exists("labels.npy"):
+        images, meta = load_packed("labels")
+        df = packed_dataframe(meta)
+    else:
+        images = None
+        df = pd.read_csv("labels.csv")
+    train_loader, val_loader = make_dataloaders(df, "fer_images", batch_size=args.batch_size,
+                                                images=images, cache="memory", tensor_aug=True)
+    teacher = load_teacher(args.teacher, device)
+
+    if not args.compare_only:
+        student = get_edge_model(args.arch, num_classes=teacher.fc[-1].out_features)
+        distill(student, teacher, train_loader, val_loader, args.epochs, args.lr, device=device)
+
+    models = {"resnet50": (teacher, None)}
+    for arch in EDGE_ARCHS:
+        if os.path.exists(f"edge_{arch}.pth"):
+            model = load_edge_model(f"edge_{arch}.pth", device)
+            models[arch] = (model, model.input_size)
+    compare_models(models, val_loader, threads=args.threads, device=device)
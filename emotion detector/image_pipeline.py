@@ -1,9 +1,11 @@
 # image_pipeline.py
-import os, random
+import os, sys, copy, math, random, time, hashlib
+import numpy as np
 import pandas as pd
 from PIL import Image
 import torch
 from torch import nn, optim
+import torch.nn.functional as F
 from torch.utils.data import Dataset, DataLoader
 from torchvision import transforms, models
 from torchvision.models import resnet50, ResNet50_Weights
@@ -15,26 +17,114 @@ from tqdm import tqdm
 # df = pd.read_csv("labels.csv")
 
 # ----- 2) Dataset -----
+# Packed datasets (converter.py): <prefix>.npy holds uint8 (N, 48, 48)
+# images and <prefix>_meta.npz the labels, class names and split indices.
+def load_packed(prefix="fer2013"):
+    """Memory-map <prefix>.npy; returns (images, meta dict)."""
+    images = np.load(prefix + ".npy", mmap_mode="r")
+    with np.load(prefix + "_meta.npz") as meta:
+        meta = {k: meta[k] for k in meta.files}
+    return images, meta
+
+def packed_dataframe(meta, split=None):
+    """index,label DataFrame for DriverImageDataset(images=...), optionally one split."""
+    idx = meta["split_" + split] if split else np.arange(len(meta["labels"]))
+    return pd.DataFrame({"index": idx, "label": meta["labels"][idx]})
+
+class SharedImageCache:
+    """
+    Decoded images, resized to size x size RGB uint8. In shared memory by
+    default; with `path`, in a memory-mapped .npy that is reused by later
+    runs. Slots are filled on first use, so the first epoch decodes and
+    every later one does not. Workers share the fills only when they are
+    forked (the Linux default); with spawn (Windows, macOS) each worker
+    fills its own copy, unless `path` is set.
+    """
+    def __init__(self, n, size=48, path=None):
+        self.size = size
+        shape = (n, size, size, 3)
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.data = self._open(path, np.uint8, shape)
+            self.filled = self._open(path[:-4] + "_filled.npy", np.bool_, (n,))
+        else:
+            # Shared before the workers fork, so every worker fills the same arrays
+            self.data = torch.zeros(shape, dtype=torch.uint8).share_memory_().numpy()
+            self.filled = torch.zeros(n, dtype=torch.bool).share_memory_().numpy()
+
+    @staticmethod
+    def _open(path, dtype, shape):
+        if os.path.exists(path):
+            arr = np.load(path, mmap_mode="r+")
+            if arr.shape == shape and arr.dtype == dtype:
+                return arr
+        return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+
+    def get(self, idx, decode):
+        if not self.filled[idx]:
+            img = decode().resize((self.size, self.size), Image.BILINEAR)
+            self.data[idx] = np.asarray(img)
+            self.filled[idx] = True
+        return self.data[idx]
+
 class DriverImageDataset(Dataset):
-    def __init__(self, df, img_dir, transform=None):
+    """
+    Images from files (df columns filename,label under img_dir) or, when
+    `images` is given, rows of a packed uint8 array (df columns index,label),
+    read straight from the memory map without decoding any file.
+    Files are decoded once per epoch, or once in total with a SharedImageCache.
+    With as_uint8=True, items are uint8 (C, raw_size, raw_size) tensors left
+    for BatchAugment to transform a whole batch at once.
+    """
+    def __init__(self, df, img_dir, transform=None, images=None, cache=None,
+                 as_uint8=False, raw_size=48):
         self.df = df.reset_index(drop=True)
         self.img_dir = img_dir
         self.transform = transform
+        self.images = images
+        self.cache = cache
+        self.as_uint8 = as_uint8
+        self.raw_size = raw_size
+        # Plain lists: df.loc per item is slower than the decode of a 48x48 face
+        self.labels = self.df['label'].astype(int).tolist()
+        if images is not None:
+            self.keys = self.df['index'].astype(int).tolist()
+        else:
+            self.keys = [os.path.join(img_dir, f) for f in self.df['filename']]
 
     def __len__(self): return len(self.df)
-    def __getitem__(self, idx):
-        row = self.df.loc[idx]
-        img_path = os.path.join(self.img_dir, row['filename'])
+
+    def _decode(self, img_path):
         try:
-            img = Image.open(img_path).convert('RGB')
+            return Image.open(img_path).convert('RGB')
         except Exception as e:
             print(f"CORRUPTED IMAGE: {img_path}")
             # return a black image instead of crashing/freezing
-            img = Image.new("RGB", (224,224))
-        img = Image.open(img_path).convert('RGB')
+            return Image.new("RGB", (224,224))
+
+    def __getitem__(self, idx):
+        key = self.keys[idx]
+        if self.as_uint8:
+            return self._raw(idx, key), self.labels[idx]
+        if self.images is not None:
+            img = Image.fromarray(self.images[key]).convert('RGB')
+        elif self.cache is not None:
+            img = Image.fromarray(self.cache.get(idx, lambda: self._decode(key)))
+        else:
+            img = self._decode(key)
         if self.transform: img = self.transform(img)
-        label = int(row['label'])
-        return img, label
+        return img, self.labels[idx]
+
+    def _raw(self, idx, key):
+        if self.images is not None:
+            arr = self.images[key]                      # (H, W) grayscale
+            return torch.from_numpy(np.array(arr)).unsqueeze(0)
+        if self.cache is not None:
+            arr = self.cache.get(idx, lambda: self._decode(key))
+        else:
+            size = (self.raw_size, self.raw_size)
+            arr = np.asarray(self._decode(key).resize(size, Image.BILINEAR))
+        return torch.from_numpy(np.array(arr)).permute(2, 0, 1)
 
 # ----- 3) Transforms -----
 train_tfms = transforms.Compose([
@@ -52,14 +142,145 @@ val_tfms = transforms.Compose([
     transforms.Normalize(mean=[0.485,0.456,0.406], std=[0.229,0.224,0.225]),
 ])
 
+# ----- 3b) Batched tensor augmentation -----
+# Same distribution as train_tfms / val_tfms, but on whole uint8 batches
+# (B, 1 or 3, H, W) at the native face size: colour jitter runs on the
+# small images, then crop + flip + upscale to 224 are one grid_sample per
+# batch and normalisation is fused at the end. Resize(256) does not change
+# the relative crop boxes of square faces, so it needs no separate step.
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+# RGB <-> YIQ: a hue shift is a rotation of the (I, Q) plane
+_RGB2YIQ = torch.tensor([[0.299, 0.587, 0.114],
+                         [0.596, -0.274, -0.322],
+                         [0.211, -0.523, 0.312]])
+_YIQ2RGB = torch.linalg.inv(_RGB2YIQ)
+
+class BatchAugment:
+    def __init__(self, train=True, out_size=224, scale=(0.08, 1.0), ratio=(3/4, 4/3),
+                 flip_p=0.5, jitter=(0.15, 0.15, 0.15, 0.05), center_frac=224/256,
+                 mean=IMAGENET_MEAN, std=IMAGENET_STD):
+        self.train = train
+        self.out_size = out_size
+        self.scale = scale
+        self.log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
+        self.flip_p = flip_p
+        self.jitter = jitter
+        self.center_frac = center_frac
+        self.mean = torch.tensor(mean).view(1, 3, 1, 1)
+        self.std = torch.tensor(std).view(1, 3, 1, 1)
+
+    def _crop_boxes(self, B, device, attempts=10):
+        """RandomResizedCrop boxes as (width, height, x0, y0) fractions of the image."""
+        area = torch.empty(B, attempts, device=device).uniform_(*self.scale)
+        log_r = torch.empty(B, attempts, device=device).uniform_(*self.log_ratio)
+        r = torch.exp(log_r)
+        w, h = torch.sqrt(area * r), torch.sqrt(area / r)
+        ok = (w <= 1) & (h <= 1)
+        # First attempt that fits, like torchvision; else the whole image
+        first = torch.where(ok.any(1), ok.float().argmax(1), torch.zeros(B, dtype=torch.long, device=device))
+        pick = lambda t: t.gather(1, first[:, None])[:, 0]
+        w = torch.where(ok.any(1), pick(w), torch.ones(B, device=device))
+        h = torch.where(ok.any(1), pick(h), torch.ones(B, device=device))
+        x0 = torch.rand(B, device=device) * (1 - w)
+        y0 = torch.rand(B, device=device) * (1 - h)
+        return w, h, x0, y0
+
+    def _color_jitter(self, x):
+        B = x.size(0)
+        b, c, s, hue = self.jitter
+        factor = lambda amount: torch.empty(B, 1, 1, 1, device=x.device).uniform_(1 - amount, 1 + amount)
+        rgb = x.size(1) == 3
+        weights = torch.tensor([0.299, 0.587, 0.114], device=x.device).view(1, 3, 1, 1)
+        gray = lambda img: (img * weights).sum(1, keepdim=True) if rgb else img
+        ops = []
+        if b: ops.append(lambda img: (img * factor(b)).clamp(0, 1))
+        if c: ops.append(lambda img: torch.lerp(gray(img).mean((2, 3), keepdim=True).expand_as(img),
+                                                img, factor(c)).clamp(0, 1))
+        # Saturation and hue do nothing to grayscale faces
+        if s and rgb: ops.append(lambda img: torch.lerp(gray(img).expand_as(img), img, factor(s)).clamp(0, 1))
+        if hue and rgb: ops.append(lambda img: self._hue(img, hue))
+        # torchvision applies the four in a random order (drawn per batch here)
+        for i in torch.randperm(len(ops)).tolist():
+            x = ops[i](x)
+        return x
+
+    def _hue(self, x, amount):
+        B = x.size(0)
+        angle = torch.empty(B, device=x.device).uniform_(-amount, amount) * 2 * math.pi
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        rot = torch.zeros(B, 3, 3, device=x.device)
+        rot[:, 0, 0] = 1
+        rot[:, 1, 1], rot[:, 1, 2] = cos, -sin
+        rot[:, 2, 1], rot[:, 2, 2] = sin, cos
+        m = _YIQ2RGB.to(x.device) @ rot @ _RGB2YIQ.to(x.device)
+        return torch.einsum('bij,bjhw->bihw', m, x).clamp(0, 1)
+
+    def __call__(self, x):
+        """uint8 (B, 1 or 3, H, W) -> normalised float (B, 3, out_size, out_size)."""
+        # Grayscale batches stay one channel until the final normalisation
+        x = x.float().div_(255)
+        B, C, device = x.size(0), x.size(1), x.device
+
+        if self.train:
+            if any(self.jitter):
+                x = self._color_jitter(x)
+            w, h, x0, y0 = self._crop_boxes(B, device)
+            flip = torch.where(torch.rand(B, device=device) < self.flip_p, -1.0, 1.0)
+        else:
+            w = h = torch.full((B,), self.center_frac, device=device)
+            x0 = y0 = (1 - w) / 2
+            flip = torch.ones(B, device=device)
+
+        # Affine grid in [-1, 1] coordinates: scale to the box, shift to its centre
+        theta = torch.zeros(B, 2, 3, device=device)
+        theta[:, 0, 0] = w * flip
+        theta[:, 0, 2] = (x0 + w / 2) * 2 - 1
+        theta[:, 1, 1] = h
+        theta[:, 1, 2] = (y0 + h / 2) * 2 - 1
+        grid = F.affine_grid(theta, (B, C, self.out_size, self.out_size), align_corners=False)
+        x = F.grid_sample(x, grid, mode='bilinear', padding_mode='border', align_corners=False)
+        return (x - self.mean.to(device)) / self.std.to(device)    # broadcasts 1 -> 3 channels
+
 # ----- 4) Build DataFrames & DataLoaders -----
-def make_dataloaders(df, img_dir, batch_size=32, val_size=0.2, seed=42):
+def default_num_workers():
+    return min(8, max(0, (os.cpu_count() or 1) - 1))
+
+def make_cache(df, cache, cache_size=48, cache_dir=".image_cache"):
+    """
+    cache: None, "memory" or "disk" (keyed by the file list, reused across runs).
+    Images are cached at cache_size x cache_size (48 = FER2013 resolution) and
+    the transforms run on the cached copy, so sources larger than cache_size
+    are downsampled: raise cache_size for high-resolution images.
+    """
+    if cache is None:
+        return None
+    if cache == "memory":
+        return SharedImageCache(len(df), cache_size)
+    key = hashlib.md5("\n".join(df['filename']).encode()).hexdigest()[:16]
+    return SharedImageCache(len(df), cache_size, os.path.join(cache_dir, f"{key}_{cache_size}.npy"))
+
+def make_loader(ds, batch_size, shuffle, num_workers=None):
+    if num_workers is None: num_workers = default_num_workers()
+    return DataLoader(ds, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers,
+                      pin_memory=torch.cuda.is_available(),
+                      persistent_workers=num_workers > 0,
+                      prefetch_factor=4 if num_workers > 0 else None)
+
+def make_dataloaders(df, img_dir, batch_size=32, val_size=0.2, seed=42, images=None,
+                     num_workers=None, cache=None, cache_size=48, tensor_aug=False):
+    """tensor_aug=True: loaders yield uint8 batches for BatchAugment instead of PIL transforms."""
     print("DEBUG: building dataloaders...")
     train_df, val_df = train_test_split(df, test_size=val_size, stratify=df['label'], random_state=seed)
-    train_ds = DriverImageDataset(train_df, img_dir, transform=train_tfms)
-    val_ds = DriverImageDataset(val_df, img_dir, transform=val_tfms)
-    train_loader = DataLoader(train_ds, batch_size=batch_size, shuffle=True, num_workers=0)
-    val_loader = DataLoader(val_ds, batch_size=batch_size, shuffle=False, num_workers=0)
+    if images is not None: cache = None     # packed arrays need no decode cache
+    raw = dict(as_uint8=True, raw_size=cache_size) if tensor_aug else {}
+    train_ds = DriverImageDataset(train_df, img_dir, transform=None if tensor_aug else train_tfms,
+                                  images=images, cache=make_cache(train_df, cache, cache_size), **raw)
+    val_ds = DriverImageDataset(val_df, img_dir, transform=None if tensor_aug else val_tfms,
+                                images=images, cache=make_cache(val_df, cache, cache_size), **raw)
+    train_loader = make_loader(train_ds, batch_size, True, num_workers)
+    val_loader = make_loader(val_ds, batch_size, False, num_workers)
     print("DEBUG: train_loader size =", len(train_loader))
     print("DEBUG: val_loader size =", len(val_loader))
     return train_loader, val_loader
@@ -85,22 +306,42 @@ def get_image_model(num_classes=5, pretrained=True, dropout=0.3):
     return model
 
 # ----- 6) Training & evaluation helpers -----
-def train_one_epoch(model, loader, optimizer, criterion, device):
+def freeze_batchnorm(model):
+    """Put every BatchNorm layer in eval mode: running stats stay as pretrained."""
+    for m in model.modules():
+        if isinstance(m, nn.modules.batchnorm._BatchNorm):
+            m.eval()
+
+def train_one_epoch(model, loader, optimizer, criterion, device, augment=None, amp_dtype=None,
+                    channels_last=False, verbose=True, max_batches=None, on_batch=None,
+                    freeze_bn=False):
+    """
+    amp_dtype: autocast dtype (torch.bfloat16 on CPU) or None for float32.
+    max_batches: stop early (resumed epochs, benchmarks); on_batch(batch_idx)
+    is called after every optimizer step.
+    freeze_bn: keep BatchNorm layers in eval mode (partial fine-tuning).
+    """
     model.train()
+    if freeze_bn: freeze_batchnorm(model)
     total_loss = 0
     total_correct = 0
     total_samples = 0
 
-    print(" train_one_epoch started")   # DEBUG
+    if verbose: print(" train_one_epoch started")   # DEBUG
 
     for batch_idx, (images, labels) in enumerate(loader):
-        if batch_idx == 0:
+        if max_batches is not None and batch_idx >= max_batches:
+            break
+        if verbose and batch_idx == 0:
             print(" First batch loaded")  # DEBUG
         images, labels = images.to(device), labels.to(device)
+        if augment is not None: images = augment(images)   # uint8 batch -> model input
+        if channels_last: images = images.contiguous(memory_format=torch.channels_last)
 
         optimizer.zero_grad()
-        outputs = model(images)
-        loss = criterion(outputs, labels)
+        with torch.autocast(device_type=device.split(':')[0], dtype=amp_dtype, enabled=amp_dtype is not None):
+            outputs = model(images)
+            loss = criterion(outputs, labels)
         loss.backward()
         optimizer.step()
 
@@ -108,44 +349,330 @@ def train_one_epoch(model, loader, optimizer, criterion, device):
         total_correct += (outputs.argmax(1) == labels).sum().item()
         total_samples += labels.size(0)
 
-        if batch_idx % 10 == 0:
+        if verbose and batch_idx % 10 == 0:
             print("Batch", batch_idx)  # DEBUG
+        if on_batch is not None: on_batch(batch_idx)
 
-    print(" train_one_epoch finished")   # DEBUG
+    if verbose: print(" train_one_epoch finished")   # DEBUG
     return total_loss / total_samples, total_correct / total_samples
 
-def eval_model(model, loader, criterion, device):
+def eval_model(model, loader, criterion, device, augment=None, amp_dtype=None, channels_last=False):
     model.eval(); running_loss = 0.0; correct=0; total=0
-    with torch.no_grad():
+    with torch.no_grad(), torch.autocast(device_type=device.split(':')[0], dtype=amp_dtype,
+                                         enabled=amp_dtype is not None):
         for x,y in loader:
             x,y = x.to(device), y.to(device)
-            logits = model(x); loss = criterion(logits,y)
+            if augment is not None: x = augment(x)
+            if channels_last: x = x.contiguous(memory_format=torch.channels_last)
+            logits = model(x); loss = criterion(logits.float(),y)
             running_loss += loss.item()*x.size(0)
             preds = logits.argmax(dim=1)
             correct += (preds==y).sum().item(); total += x.size(0)
     return running_loss/total, correct/total
 
+# ----- 6b) CPU training mode -----
+def cpu_supports_bf16():
+    """Native bf16 matmuls: AVX512-BF16 / AMX on x86, BF16 on ARM (Linux cpuinfo flags)."""
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = set(f.read().split())
+    except OSError:
+        return False
+    return bool(flags & {"avx512_bf16", "amx_bf16", "bf16"})
+
+def setup_cpu_threads(threads=None, loader_workers=0, interop_threads=1):
+    """Intra-op threads on the cores the DataLoader workers leave free; one inter-op thread."""
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1) - loader_workers)
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(interop_threads)
+    except RuntimeError:
+        pass    # only settable before the first parallel op of the process
+    return threads
+
+def save_checkpoint(path, model, optimizer, epoch, batch, best_val_acc):
+    """
+    epoch: last finished epoch; batch: steps done in the next one. Written to
+    a temp file and renamed, so an interrupted save keeps the previous one.
+    """
+    tmp = path + ".tmp"
+    torch.save({"model": model.state_dict(), "optimizer": optimizer.state_dict(),
+                "epoch": epoch, "batch": batch, "best_val_acc": best_val_acc}, tmp)
+    os.replace(tmp, path)
+
+def load_checkpoint(path, model, optimizer):
+    ckpt = torch.load(path, map_location="cpu")
+    model.load_state_dict(ckpt["model"])
+    optimizer.load_state_dict(ckpt["optimizer"])
+    return ckpt["epoch"], ckpt["batch"], ckpt["best_val_acc"]
+
 # ----- 7) Full train function -----
-def train_image(df, img_dir, num_classes=5, batch_size=32, epochs=8, lr=1e-4, device=None):
+def train_image(df, img_dir, num_classes=5, batch_size=32, epochs=8, lr=1e-4, device=None,
+                images=None, num_workers=None, cache=None, cache_size=48, tensor_aug=False,
+                cpu_opt=False, bf16=None, torch_compile=False, threads=None,
+                checkpoint=None, resume=False, checkpoint_minutes=10):
+    """
+    cache="memory"/"disk" decodes each image once (see make_cache); the
+    cached copy is cache_size x cache_size, so only use it with images no
+    larger than that (FER2013) or raise cache_size.
+    cpu_opt=True (CPU only): channels_last, tuned threads, bf16 autocast
+    (bf16=None: only on CPUs with native bf16) and, with torch_compile=True,
+    torch.compile. Given a checkpoint path, a checkpoint is written after
+    every epoch and every checkpoint_minutes within one; resume=True
+    continues from it (the interrupted epoch runs its remaining batches,
+    freshly shuffled).
+    """
     print("DEBUG: train_image() STARTED, device =", device)
+    if resume and not checkpoint:
+        raise ValueError("resume=True needs a checkpoint path")
     if device is None: device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    train_loader, val_loader = make_dataloaders(df, img_dir, batch_size=batch_size)
+    cpu_opt = cpu_opt and device == 'cpu'
+    amp_dtype = None
+    if cpu_opt:
+        if num_workers is None: num_workers = min(2, default_num_workers())
+        print("CPU mode:", setup_cpu_threads(threads, num_workers), "threads")
+        if bf16 is None: bf16 = cpu_supports_bf16()
+        if bf16: amp_dtype = torch.bfloat16
+    train_loader, val_loader = make_dataloaders(df, img_dir, batch_size=batch_size, images=images,
+                                                num_workers=num_workers, cache=cache,
+                                                cache_size=cache_size, tensor_aug=tensor_aug)
+    train_aug = BatchAugment(train=True) if tensor_aug else None
+    val_aug = BatchAugment(train=False) if tensor_aug else None
     model = get_image_model(num_classes=num_classes).to(device)
+    if cpu_opt: model = model.to(memory_format=torch.channels_last)
     optimizer = optim.AdamW(model.parameters(), lr=lr)
     # optional: compute class weights if imbalanced
     # weights = torch.tensor([...], device=device)
     criterion = nn.CrossEntropyLoss()  # or nn.CrossEntropyLoss(weight=weights)
     scaler = torch.cuda.amp.GradScaler() if device.startswith('cuda') else None
 
-    best_val_acc = 0.0
+    best_val_acc, start_epoch, skip = 0.0, 1, 0
+    if resume and os.path.exists(checkpoint):
+        done, skip, best_val_acc = load_checkpoint(checkpoint, model, optimizer)
+        start_epoch = done + 1
+        print(f"Resumed from {checkpoint}: epoch {start_epoch}, batch {skip}, best val acc {best_val_acc:.4f}")
+    # Compiled graph for the steps; `model` (same weights) is what gets saved
+    net = torch.compile(model) if torch_compile and hasattr(torch, "compile") else model
+
+    last_save = time.perf_counter()
+    def on_batch(batch_idx):
+        nonlocal last_save
+        if checkpoint and checkpoint_minutes and time.perf_counter() - last_save > 60 * checkpoint_minutes:
+            save_checkpoint(checkpoint, model, optimizer, epoch - 1, skip + batch_idx + 1, best_val_acc)
+            last_save = time.perf_counter()
+
     print("Starting training...")
-    for epoch in range(1, epochs+1):
-        train_loss, train_acc = train_one_epoch(model, train_loader, optimizer, criterion, device)
-        val_loss, val_acc = eval_model(model, val_loader, criterion, device)
-        print(f"Epoch {epoch}: train_loss={train_loss:.4f} train_acc={train_acc:.4f} val_acc={val_acc:.4f}")
+    for epoch in range(start_epoch, epochs+1):
+        t0 = time.perf_counter()
+        train_loss, train_acc = train_one_epoch(net, train_loader, optimizer, criterion, device, train_aug,
+                                                amp_dtype=amp_dtype, channels_last=cpu_opt,
+                                                verbose=not cpu_opt,
+                                                max_batches=len(train_loader) - skip, on_batch=on_batch)
+        skip = 0
+        val_loss, val_acc = eval_model(net, val_loader, criterion, device, val_aug,
+                                       amp_dtype=amp_dtype, channels_last=cpu_opt)
+        print(f"Epoch {epoch}: train_loss={train_loss:.4f} train_acc={train_acc:.4f} val_acc={val_acc:.4f} "
+              f"({time.perf_counter() - t0:.0f}s)")
         if val_acc > best_val_acc:
             best_val_acc = val_acc
             torch.save(model.state_dict(), "best_image_model.pth")
+        if checkpoint:
+            save_checkpoint(checkpoint, model, optimizer, epoch, 0, best_val_acc)
+            last_save = time.perf_counter()
     print("Best val acc:", best_val_acc)
     return model
 
+# ----- 7b) Frozen-backbone feature cache -----
+# The backbone barely changes when fine-tuning on a few thousand faces, so
+# run it once: view 0 with the validation transform plus `views` fixed
+# (seeded) training augmentations of every image, stored as float16
+# (1 + views, N, 2048) in a memory-mapped .npy. Only model.fc is trained on
+# those features. The cache depends on the images, not on the labels, so a
+# new label set only retrains the head.
+def backbone_of(model):
+    """Everything but model.fc, sharing its weights."""
+    return nn.Sequential(*list(model.children())[:-1], nn.Flatten())
+
+def dataset_key(df):
+    col = 'filename' if 'filename' in df else 'index'
+    return hashlib.md5("\n".join(map(str, df[col])).encode()).hexdigest()[:16]
+
+def extract_features(model, df, img_dir, cache_path, views=4, batch_size=64, images=None,
+                     num_workers=None, device='cpu', seed=0):
+    """Fill (or reuse, view by view) the feature cache at cache_path."""
+    n_views, feat_dim = 1 + views, model.fc[1].in_features
+    os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+    feats = SharedImageCache._open(cache_path, np.float16, (n_views, len(df), feat_dim))
+    done = SharedImageCache._open(cache_path[:-4] + "_done.npy", np.bool_, (n_views,))
+    if done.all():
+        return feats
+
+    backbone = backbone_of(model).to(device).eval()
+    ds = DriverImageDataset(df, img_dir, images=images, as_uint8=True,
+                            cache=None if images is not None else make_cache(df, "memory"))
+    loader = make_loader(ds, batch_size, False, num_workers)
+    for v in range(n_views):
+        if done[v]: continue
+        augment = BatchAugment(train=v > 0)
+        torch.manual_seed(seed + v)         # the same views every time
+        t0, pos = time.perf_counter(), 0
+        with torch.inference_mode():
+            for x, _ in loader:
+                f = backbone(augment(x.to(device)))
+                feats[v, pos:pos + len(f)] = f.cpu().numpy().astype(np.float16)
+                pos += len(f)
+        feats.flush()
+        done[v] = True; done.flush()
+        print(f"features view {v}/{views}: {len(df)} images in {time.perf_counter() - t0:.1f}s")
+    return feats
+
+def train_head(head, feats, labels, train_rows, val_rows, epochs=30, lr=1e-3,
+               batch_size=256, device='cpu'):
+    """
+    Train only the head on cached features: every (view, train row) pair is
+    a sample; validation uses view 0. Keeps the best epoch's weights.
+    """
+    head = head.to(device)
+    labels = torch.as_tensor(np.asarray(labels), dtype=torch.long)
+    views = np.arange(feats.shape[0])
+    pairs = np.stack(np.meshgrid(views, train_rows, indexing='ij'), -1).reshape(-1, 2)
+    val_x = torch.from_numpy(np.asarray(feats[0, val_rows], dtype=np.float32)).to(device)
+    val_y = labels[val_rows].to(device)
+    optimizer = optim.AdamW(head.parameters(), lr=lr)
+    criterion = nn.CrossEntropyLoss()
+
+    best_acc, best_state = -1.0, None
+    for epoch in range(1, epochs + 1):
+        head.train()
+        order = np.random.permutation(len(pairs))
+        for i in range(0, len(order), batch_size):
+            v, r = pairs[order[i:i + batch_size]].T
+            x = torch.from_numpy(np.asarray(feats[v, r], dtype=np.float32)).to(device)
+            optimizer.zero_grad()
+            loss = criterion(head(x), labels[r].to(device))
+            loss.backward()
+            optimizer.step()
+        head.eval()
+        with torch.no_grad():
+            val_acc = (head(val_x).argmax(1) == val_y).float().mean().item()
+        if val_acc > best_acc:
+            best_acc, best_state = val_acc, copy.deepcopy(head.state_dict())
+    head.load_state_dict(best_state)
+    return best_acc
+
+def train_image_cached(df, img_dir, num_classes=5, views=4, head_epochs=30, head_lr=1e-3,
+                       unfreeze_epochs=0, unfreeze_lr=1e-5, batch_size=64, images=None,
+                       cache_dir="feature_cache", val_size=0.2, seed=42, device=None):
+    """
+    Fast alternative to train_image: frozen backbone features (cached) +
+    head training, then optionally `unfreeze_epochs` of fine-tuning layer4
+    and the head on images.
+    """
+    if device is None: device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model = get_image_model(num_classes=num_classes).to(device)
+    cache_path = os.path.join(cache_dir, f"{dataset_key(df)}_v{views}.npy")
+    feats = extract_features(model, df, img_dir, cache_path, views, batch_size, images,
+                             device=device)
+
+    # Same rows as make_dataloaders' split (same size, stratify and seed)
+    train_rows, val_rows = train_test_split(np.arange(len(df)), test_size=val_size,
+                                            stratify=df['label'], random_state=seed)
+    t0 = time.perf_counter()
+    best_val_acc = train_head(model.fc, feats, df['label'].to_numpy(), train_rows, val_rows,
+                              head_epochs, head_lr, device=device)
+    print(f"Head trained in {time.perf_counter() - t0:.1f}s: val_acc={best_val_acc:.4f}")
+    torch.save(model.state_dict(), "best_image_model.pth")
+
+    if unfreeze_epochs:
+        for p in model.parameters(): p.requires_grad = False
+        for p in list(model.layer4.parameters()) + list(model.fc.parameters()): p.requires_grad = True
+        train_loader, val_loader = make_dataloaders(df, img_dir, batch_size=batch_size, val_size=val_size,
+                                                    seed=seed, images=images, cache="memory",
+                                                    tensor_aug=True)
+        optimizer = optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=unfreeze_lr)
+        criterion = nn.CrossEntropyLoss()
+        for epoch in range(1, unfreeze_epochs + 1):
+            # BN stays in eval mode: the running stats of the whole backbone were
+            # estimated on large batches and small fine-tuning batches would skew them
+            train_loss, train_acc = train_one_epoch(model, train_loader, optimizer, criterion, device,
+                                                    BatchAugment(train=True), freeze_bn=True)
+            val_loss, val_acc = eval_model(model, val_loader, criterion, device, BatchAugment(train=False))
+            print(f"Unfrozen epoch {epoch}: train_loss={train_loss:.4f} val_acc={val_acc:.4f}")
+            if val_acc > best_val_acc:
+                best_val_acc = val_acc
+                torch.save(model.state_dict(), "best_image_model.pth")
+    print("Best val acc:", best_val_acc)
+    return model
+
+# ----- 8) Data loading throughput -----
+def loader_throughput(loader, max_batches=None, augment=None):
+    """Images/sec for one pass over a DataLoader (no model)."""
+    n = 0
+    t0 = time.perf_counter()
+    for batch_idx, (images, labels) in enumerate(loader):
+        if augment is not None: images = augment(images)
+        n += images.size(0)
+        if max_batches is not None and batch_idx + 1 >= max_batches:
+            break
+    return n / (time.perf_counter() - t0)
+
+def benchmark_loading(df, img_dir, batch_size=64, max_batches=50, num_workers=None):
+    """Images/sec of the training loader: before (1 process, no cache) vs after."""
+    if num_workers is None: num_workers = default_num_workers()
+    configs = [("before: 1 process, no cache", 0, None),
+               (f"{num_workers} workers, no cache", num_workers, None),
+               (f"{num_workers} workers, memory cache", num_workers, "memory")]
+    for name, workers, cache in configs:
+        train_loader, _ = make_dataloaders(df, img_dir, batch_size=batch_size,
+                                           num_workers=workers, cache=cache)
+        rates = [loader_throughput(train_loader, max_batches) for _ in range(2 if cache else 1)]
+        print(f"{name:>34}: " + ", ".join(f"epoch {i + 1} {r:,.0f} img/s" for i, r in enumerate(rates)))
+
+def benchmark_augmentation(df, img_dir, batch_size=64, max_batches=50, num_workers=None):
+    """CPU epoch time of the input pipeline: per-sample PIL transforms vs BatchAugment."""
+    n_batches = max_batches or math.ceil(0.8 * len(df) / batch_size)
+    for name, tensor_aug in (("PIL transforms per sample", False), ("BatchAugment per batch", True)):
+        train_loader, _ = make_dataloaders(df, img_dir, batch_size=batch_size, num_workers=num_workers,
+                                           cache="memory", tensor_aug=tensor_aug)
+        augment = BatchAugment(train=True) if tensor_aug else None
+        loader_throughput(train_loader, max_batches, augment)      # fills the cache
+        rate = loader_throughput(train_loader, max_batches, augment)
+        epoch_s = 0.8 * len(df) / rate
+        print(f"{name:>28}: {rate:,.0f} img/s, ~{epoch_s:.1f} s per epoch ({n_batches} batches timed)")
+
+def benchmark_cpu_training(df, img_dir, batch_size=32, max_batches=10, num_workers=None):
+    """Training img/s on CPU: float32 eager vs channels_last vs bf16 vs torch.compile."""
+    if num_workers is None: num_workers = min(2, default_num_workers())
+    print("threads:", setup_cpu_threads(None, num_workers), "| native bf16:", cpu_supports_bf16())
+    train_loader, _ = make_dataloaders(df, img_dir, batch_size=batch_size, num_workers=num_workers,
+                                       cache="memory", tensor_aug=True)
+    augment, criterion = BatchAugment(train=True), nn.CrossEntropyLoss()
+    configs = [("float32 eager (before)", None, False, False),
+               ("channels_last", None, True, False),
+               ("channels_last + bf16", torch.bfloat16, True, False)]
+    if hasattr(torch, "compile"):
+        configs.append(("channels_last + bf16 + compile", torch.bfloat16, True, True))
+    n_batches = min(max_batches, len(train_loader))
+    for name, amp_dtype, channels_last, compiled in configs:
+        model = get_image_model(num_classes=int(df['label'].max()) + 1, pretrained=False)
+        if channels_last: model = model.to(memory_format=torch.channels_last)
+        net = torch.compile(model) if compiled else model
+        optimizer = optim.AdamW(model.parameters(), lr=1e-4)
+        run = lambda n: train_one_epoch(net, train_loader, optimizer, criterion, 'cpu', augment,
+                                        amp_dtype=amp_dtype, channels_last=channels_last,
+                                        verbose=False, max_batches=n)
+        run(2)                                  # warm-up, compilation, cache fill
+        t0 = time.perf_counter()
+        run(n_batches)
+        rate = n_batches * batch_size / (time.perf_counter() - t0)
+        epoch_min = len(train_loader.dataset) / rate / 60
+        print(f"{name:>32}: {rate:,.1f} img/s, ~{epoch_min:.1f} min per epoch")
+
+if __name__ == "__main__":
+    df = pd.read_csv("labels.csv")
+    if "--train-bench" in sys.argv:
+        benchmark_cpu_training(df, "fer_images")
+        sys.exit(0)
+    benchmark_loading(df, "fer_images")
+    benchmark_augmentation(df, "fer_images")
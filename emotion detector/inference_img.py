@@ -1,4 +1,14 @@
 # inference_image.py
+# Models are loaded on first use (get_model), one per variant:
+#   float         eager PyTorch, float32 (the original)
+#   dynamic_int8  Linear layers quantized at run time (weights int8)
+#   static_int8   convs + linears quantized, activation ranges calibrated on fer_images
+#   torchscript   traced + frozen float model, saved as best_image_model.ts.pt
+#   onnx          exported best_image_model.onnx run by onnxruntime (optional)
+#   python inference_img.py --bench        size / latency / parity table for all variants
+#   python inference_img.py --bench-batch  predict_batch throughput by batch size
+import os, io, sys, time, glob, random, platform, threading
+from concurrent.futures import ThreadPoolExecutor
 import torch, numpy as np
 from torchvision import transforms, models
 from PIL import Image
@@ -25,23 +35,304 @@ val_tfms = transforms.Compose([
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 num_classes = 9
-model = get_image_model(num_classes=num_classes, pretrained=False)
-state = torch.load("best_image_model.pth", map_location=device)
-model.load_state_dict(state)
-model.to(device)
-model.eval()
+MODEL_PATH = "best_image_model.pth"
+TS_PATH = "best_image_model.ts.pt"
+ONNX_PATH = "best_image_model.onnx"
+# Quantized kernels: qnnpack on ARM (Raspberry Pi), x86 otherwise
+QUANT_ENGINE = "qnnpack" if platform.machine().lower() in ("aarch64", "arm64", "armv7l") else "x86"
 
 label_map = {0:"angry", 1:"disgust", 2:"fear", 3:"happy", 4:"sad", 5:"surprise", 6:"neutral", 7:"drunk", 8:"sleepy" }
 
-def predict_image(image_path):
-    img = Image.open(image_path).convert('RGB')
-    x = val_tfms(img).unsqueeze(0).to(device)
-    with torch.no_grad():
-        logits = model(x)
-        probs = torch.softmax(logits, dim=1).cpu().numpy()[0]
+# ----- Calibration data -----
+def list_images(img_dir="fer_images"):
+    return sorted(p for ext in ("png", "jpg", "jpeg")
+                  for p in glob.glob(os.path.join(img_dir, "**", "*." + ext), recursive=True))
+
+def calibration_batches(img_dir="fer_images", n=256, batch_size=32, seed=0):
+    """A fixed random sample of n images, as val_tfms batches."""
+    paths = list_images(img_dir)
+    paths = random.Random(seed).sample(paths, min(n, len(paths)))
+    for i in range(0, len(paths), batch_size):
+        yield torch.stack([val_tfms(Image.open(p).convert('RGB')) for p in paths[i:i + batch_size]])
+
+# ----- Variants -----
+# Every builder takes the float checkpoint path (None = MODEL_PATH)
+def _load_float(map_location=device, path=None):
+    model = get_image_model(num_classes=num_classes, pretrained=False)
+    state = torch.load(path or MODEL_PATH, map_location=map_location)
+    model.load_state_dict(state)
+    return model.eval()
+
+def _export_path(path, default, ext):
+    """Where the TorchScript / ONNX export of checkpoint `path` lives."""
+    if path is None or path == MODEL_PATH: return default
+    return os.path.splitext(path)[0] + ext
+
+def build_float(path=None):
+    return _load_float(path=path).to(device)
+
+def build_dynamic_int8(path=None):
+    torch.backends.quantized.engine = QUANT_ENGINE
+    return torch.ao.quantization.quantize_dynamic(_load_float('cpu', path), {nn.Linear}, dtype=torch.qint8)
+
+def build_static_int8(path=None, img_dir="fer_images", n_calib=256):
+    """FX graph mode post-training quantization, calibrated on n_calib images."""
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    torch.backends.quantized.engine = QUANT_ENGINE
+    model = _load_float('cpu', path)
+    example = (torch.randn(1, 3, 224, 224),)
+    prepared = prepare_fx(model, get_default_qconfig_mapping(QUANT_ENGINE), example)
+    with torch.inference_mode():
+        for x in calibration_batches(img_dir, n_calib):
+            prepared(x)
+    return convert_fx(prepared)
+
+def build_torchscript(path=None):
+    ts_path = _export_path(path, TS_PATH, ".ts.pt")
+    if not os.path.exists(ts_path) or os.path.getmtime(ts_path) < os.path.getmtime(path or MODEL_PATH):
+        model = _load_float('cpu', path)
+        with torch.inference_mode():
+            traced = torch.jit.freeze(torch.jit.trace(model, torch.randn(1, 3, 224, 224)))
+        traced.save(ts_path)
+    return torch.jit.load(ts_path, map_location=device).eval()
+
+def build_onnx(path=None):
+    try:
+        import onnxruntime as ort
+    except ImportError:
+        raise ImportError("the onnx variant needs onnxruntime: pip install onnx onnxruntime")
+    onnx_path = _export_path(path, ONNX_PATH, ".onnx")
+    if not os.path.exists(onnx_path) or os.path.getmtime(onnx_path) < os.path.getmtime(path or MODEL_PATH):
+        torch.onnx.export(_load_float('cpu', path), torch.randn(1, 3, 224, 224), onnx_path,
+                          input_names=["input"], output_names=["logits"],
+                          dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}},
+                          opset_version=17)
+    sess = ort.InferenceSession(onnx_path, providers=["CPUExecutionProvider"])
+    return lambda x: torch.from_numpy(sess.run(None, {"input": x.cpu().numpy()})[0])
+
+VARIANTS = {
+    "float": build_float,
+    "dynamic_int8": build_dynamic_int8,
+    "static_int8": build_static_int8,
+    "torchscript": build_torchscript,
+    "onnx": build_onnx,
+}
+# Quantized kernels and onnxruntime here run on the CPU only
+CPU_ONLY = {"dynamic_int8", "static_int8", "onnx"}
+
+_models = {}        # (variant, checkpoint path) -> model
+_models_lock = threading.Lock()
+call_stats = {}     # variant -> [calls, seconds]
+
+def get_model(variant="float", model_path=None):
+    """
+    The model for `variant` of checkpoint model_path (None = MODEL_PATH),
+    built/loaded on first use (once, even from several threads).
+    """
+    key = (variant, model_path or MODEL_PATH)
+    model = _models.get(key)
+    if model is None:
+        with _models_lock:
+            model = _models.get(key)
+            if model is None:
+                t0 = time.perf_counter()
+                model = _models[key] = VARIANTS[variant](model_path)
+                print(f"Loaded {variant} model in {time.perf_counter() - t0:.1f}s")
+    return model
+
+def model_size_mb(variant):
+    """Serialized size: the exported file for torchscript/onnx, else the saved state dict."""
+    if variant == "torchscript": path = TS_PATH
+    elif variant == "onnx": path = ONNX_PATH
+    else:
+        buf = io.BytesIO()
+        torch.save(get_model(variant).state_dict(), buf)
+        return buf.tell() / 1e6
+    get_model(variant)
+    return os.path.getsize(path) / 1e6
+
+# ----- Prediction -----
+def predict_tensor(x, variant="float", model_path=None):
+    """val_tfms batch (N, 3, 224, 224) -> softmax probabilities (N, num_classes)."""
+    model = get_model(variant, model_path)
+    x = x.to('cpu' if variant in CPU_ONLY else device)
+    t0 = time.perf_counter()
+    with torch.inference_mode():
+        probs = torch.softmax(model(x), dim=1).cpu().numpy()
+    stats = call_stats.setdefault(variant, [0, 0.0])
+    stats[0] += 1
+    stats[1] += time.perf_counter() - t0
     return probs
 
+def predict_image(image_path, variant="float"):
+    img = Image.open(image_path).convert('RGB')
+    return predict_tensor(val_tfms(img).unsqueeze(0), variant)[0]
+
+# ----- Batched / streaming prediction -----
+_pools = {}
+
+def _decode_pool(workers=None):
+    """Shared decode threads (PIL and the torch transforms release the GIL)."""
+    workers = workers or min(8, os.cpu_count() or 1)
+    if workers not in _pools:
+        _pools[workers] = ThreadPoolExecutor(workers)
+    return _pools[workers]
+
+def _to_tensor(item, bgr=False):
+    """Path or uint8 face crop (H, W) / (H, W, 3) -> val_tfms tensor."""
+    if isinstance(item, (str, os.PathLike)):
+        img = Image.open(item).convert('RGB')
+    else:
+        arr = np.asarray(item)
+        if bgr and arr.ndim == 3: arr = arr[..., ::-1]
+        img = Image.fromarray(np.ascontiguousarray(arr)).convert('RGB')
+    return val_tfms(img)
+
+def predict_batch(items, variant="float", batch_size=32, workers=None, bgr=False, model_path=None):
+    """
+    Probabilities (N, num_classes) for image paths and/or uint8 face crops
+    (RGB, or BGR straight from OpenCV with bgr=True). Items are decoded on a
+    thread pool one batch ahead of the model; each batch is one forward pass.
+    """
+    items = list(items)
+    if not items:
+        return np.empty((0, num_classes), dtype=np.float32)
+    pool = _decode_pool(workers)
+    chunks = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+    submit = lambda chunk: [pool.submit(_to_tensor, item, bgr) for item in chunk]
+
+    pending, out = submit(chunks[0]), []
+    for k in range(len(chunks)):
+        x = torch.stack([f.result() for f in pending])
+        if k + 1 < len(chunks): pending = submit(chunks[k + 1])
+        out.append(predict_tensor(x, variant, model_path))
+    return np.concatenate(out)
+
+def predict_folder(img_dir="fer_images", variant="float", batch_size=32, workers=None):
+    """(paths, probabilities) for every image under img_dir."""
+    paths = list_images(img_dir)
+    return paths, predict_batch(paths, variant, batch_size, workers)
+
+class EmotionStream:
+    """
+    Face crops from video in, smoothed class probabilities out. Crops are
+    scored batch_size at a time; every `window` scored frames give one result:
+    the window's mean probabilities, EMA-smoothed (alpha) across windows.
+    """
+    def __init__(self, variant="float", batch_size=8, window=15, alpha=0.5, bgr=True,
+                 model_path=None):
+        self.variant = variant
+        self.model_path = model_path
+        self.batch_size = batch_size
+        self.window = window
+        self.alpha = alpha
+        self.bgr = bgr
+        self._faces, self._times = [], []
+        self._scored = []          # (timestamp, probs) not yet in a window
+        self.smoothed = None
+
+    def push(self, face, timestamp=None):
+        """Add one face crop; returns the window results it completed (usually none)."""
+        self._faces.append(face)
+        self._times.append(time.time() if timestamp is None else timestamp)
+        if len(self._faces) >= self.batch_size:
+            self._score()
+        return self._windows()
+
+    def flush(self):
+        """Score what is buffered and close a partial last window."""
+        self._score()
+        return self._windows(partial=True)
+
+    def _score(self):
+        if not self._faces: return
+        probs = predict_batch(self._faces, self.variant, self.batch_size, bgr=self.bgr,
+                              model_path=self.model_path)
+        self._scored.extend(zip(self._times, probs))
+        self._faces, self._times = [], []
+
+    def _windows(self, partial=False):
+        results = []
+        while len(self._scored) >= self.window or (partial and self._scored):
+            chunk, self._scored = self._scored[:self.window], self._scored[self.window:]
+            mean = np.mean([p for _, p in chunk], axis=0)
+            self.smoothed = mean if self.smoothed is None else \
+                self.alpha * mean + (1 - self.alpha) * self.smoothed
+            pred = int(np.argmax(self.smoothed))
+            results.append({"start": chunk[0][0], "end": chunk[-1][0], "frames": len(chunk),
+                            "probs": self.smoothed.copy(), "label": label_map[pred],
+                            "confidence": float(self.smoothed[pred])})
+        return results
+
+def latency_report():
+    """Mean ms per call of every variant used so far."""
+    for variant, (calls, seconds) in call_stats.items():
+        print(f"{variant:>13}: {calls} calls, {1000 * seconds / calls:.2f} ms/call")
+
+# ----- Benchmark -----
+def benchmark_variants(variants=tuple(VARIANTS), img_dir="fer_images", n_parity=500, runs=50):
+    """
+    Size, batch-1 latency and parity with the float model (top-1 agreement and
+    mean |probability difference|) on n_parity images from img_dir.
+    """
+    paths = list_images(img_dir)
+    paths = random.Random(1).sample(paths, min(n_parity, len(paths)))
+    batches = [torch.stack([val_tfms(Image.open(p).convert('RGB')) for p in paths[i:i + 32]])
+               for i in range(0, len(paths), 32)]
+    ref = np.concatenate([predict_tensor(x, "float") for x in batches])
+    one = batches[0][:1]
+
+    print(f"{'variant':>13} {'size MB':>8} {'ms/call':>8} {'top1 agree':>11} {'mean |dp|':>10}")
+    rows = []
+    for variant in variants:
+        try:
+            get_model(variant)
+        except ImportError as e:
+            print(f"{variant:>13}: skipped ({e})")
+            continue
+        for _ in range(5): predict_tensor(one, variant)        # warm-up
+        times = []
+        for _ in range(runs):
+            t = time.perf_counter()
+            predict_tensor(one, variant)
+            times.append(time.perf_counter() - t)
+        probs = np.concatenate([predict_tensor(x, variant) for x in batches])
+        agree = float((probs.argmax(1) == ref.argmax(1)).mean())
+        dp = float(np.abs(probs - ref).mean())
+        ms = 1000 * float(np.median(times))
+        size = model_size_mb(variant)
+        print(f"{variant:>13} {size:>8.1f} {ms:>8.2f} {agree:>11.2%} {dp:>10.4f}")
+        rows.append(dict(variant=variant, size_mb=size, ms=ms, top1_agree=agree, mean_abs_dp=dp))
+    return rows
+
+def benchmark_batch_sizes(img_dir="fer_images", sizes=(1, 4, 8, 16, 32, 64), n=512,
+                          variant="float", workers=None):
+    """predict_batch images/sec by batch size, from files and from in-memory crops."""
+    paths = list_images(img_dir)
+    paths = random.Random(2).sample(paths, min(n, len(paths)))
+    crops = [np.asarray(Image.open(p).convert('L')) for p in paths]
+    predict_batch(paths[:8], variant)                   # load + warm-up
+    print(f"{'batch':>6} {'files img/s':>12} {'crops img/s':>12}")
+    rows = []
+    for bs in sizes:
+        rates = []
+        for items in (paths, crops):
+            t0 = time.perf_counter()
+            predict_batch(items, variant, bs, workers)
+            rates.append(len(items) / (time.perf_counter() - t0))
+        print(f"{bs:>6} {rates[0]:>12,.1f} {rates[1]:>12,.1f}")
+        rows.append(dict(batch=bs, files_per_s=rates[0], crops_per_s=rates[1]))
+    return rows
+
 if __name__ == "__main__":
+    if "--bench-batch" in sys.argv:
+        benchmark_batch_sizes()
+        sys.exit(0)
+    if "--bench" in sys.argv:
+        benchmark_variants()
+        sys.exit(0)
     test_image = "fer_images/sleepy2.png"  # <- change to your image filename
     probs = predict_image(test_image)
     for i,p in enumerate(probs):
@@ -1,14 +1,31 @@
+import os, sys
 import pandas as pd
-from image_pipeline import train_image
+from image_pipeline import train_image, train_image_cached, load_packed, packed_dataframe
 
 if __name__ == "__main__":
-    df = pd.read_csv("labels.csv")
+    # Packed by `python converter.py --from-labels labels.csv` (no PNG decoding)
+    if os.path.exists("labels.npy"):
+        images, meta = load_packed("labels")
+        df = packed_dataframe(meta)
+    else:
+        images = None
+        df = pd.read_csv("labels.csv")
+    if "--cached" in sys.argv:
+        # Backbone features computed once (feature_cache/), then only the head trains
+        model = train_image_cached(df, img_dir="fer_images", num_classes=5, images=images)
+        sys.exit(0)
     model = train_image(
         df,
         img_dir="fer_images",
         num_classes=5,
         batch_size=16,
         epochs=8,
-        lr=1e-4
+        lr=1e-4,
+        images=images,
+        cache="memory",                      # fer_images are 48x48, the cache size
+        cpu_opt="--cpu-opt" in sys.argv,     # bf16 / channels_last / threads on CPU
+        # --checkpoint saves image_checkpoint.pth each epoch, --resume continues from it
+        checkpoint="image_checkpoint.pth" if {"--checkpoint", "--resume"} & set(sys.argv) else None,
+        resume="--resume" in sys.argv
     )
 
@@ -0,0 +1,71 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchvision")
+from PIL import Image  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import inference_img as inf  # noqa: E402
+
+
+@pytest.fixture
+def float_model(tmp_path, monkeypatch):
+    """A random-weight checkpoint and a few calibration images in tmp_path."""
+    torch.manual_seed(0)
+    model = inf.get_image_model(num_classes=inf.num_classes)
+    torch.save(model.state_dict(), tmp_path / "model.pth")
+    rng = np.random.default_rng(0)
+    os.makedirs(tmp_path / "fer_images" / "happy")
+    for i in range(8):
+        img = rng.integers(0, 255, (48, 48), dtype=np.uint8)
+        Image.fromarray(img).convert("RGB").save(tmp_path / "fer_images" / "happy" / f"{i}.png")
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(inf, "MODEL_PATH", str(tmp_path / "model.pth"))
+    monkeypatch.setattr(inf, "TS_PATH", str(tmp_path / "model.ts.pt"))
+    monkeypatch.setattr(inf, "ONNX_PATH", str(tmp_path / "model.onnx"))
+    monkeypatch.setattr(inf, "_models", {})
+    return torch.stack([inf.val_tfms(Image.open(p).convert("RGB"))
+                        for p in inf.list_images("fer_images")])
+
+
+@pytest.mark.parametrize("variant, max_dp", [
+    ("torchscript", 1e-4),
+    ("onnx", 1e-4),
+    ("dynamic_int8", 0.05),
+    ("static_int8", 0.2),
+])
+def test_variant_matches_float_model(float_model, variant, max_dp):
+    if variant == "onnx":
+        pytest.importorskip("onnxruntime")
+        pytest.importorskip("onnx")
+    ref = inf.predict_tensor(float_model, "float")
+    probs = inf.predict_tensor(float_model, variant)
+
+    assert probs.shape == ref.shape
+    np.testing.assert_allclose(probs.sum(axis=1), 1.0, atol=1e-4)
+    assert np.abs(probs - ref).mean() < max_dp
+
+
+def test_get_model_builds_once_across_threads(monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    import time
+    builds = []
+
+    def slow_build(path=None):
+        time.sleep(0.05)        # long enough for every thread to miss the cache
+        builds.append(1)
+        return object()
+
+    monkeypatch.setattr(inf, "_models", {})
+    monkeypatch.setitem(inf.VARIANTS, "float", slow_build)
+
+    with ThreadPoolExecutor(8) as pool:
+        models = list(pool.map(lambda _: inf.get_model("float"), range(32)))
+
+    assert len(builds) == 1
+    assert all(m is models[0] for m in models)
@@ -0,0 +1,93 @@
+import importlib.machinery
+import importlib.util
+import os
+
+import numpy as np
+from sklearn.ensemble import RandomForestRegressor
+
+# TurnDetector is a script without a .py extension
+_loader = importlib.machinery.SourceFileLoader(
+    "turn_detector", os.path.join(os.path.dirname(os.path.abspath(__file__)), "TurnDetector"))
+td = importlib.util.module_from_spec(importlib.util.spec_from_loader("turn_detector", _loader))
+_loader.exec_module(td)
+
+
+def make_forest(n_samples=500, n_features=6, seed=0):
+    rng = np.random.default_rng(seed)
+    X = rng.uniform(0, 100, (n_samples, n_features))
+    y = 20 + 0.2 * X[:, 0] - 0.1 * X[:, 1] + rng.normal(0, 3, n_samples)
+    return RandomForestRegressor(n_estimators=20, random_state=seed).fit(X, y), rng
+
+
+def test_flat_forest_matches_sklearn():
+    forest, rng = make_forest()
+    flat = td.FlatForest(forest)
+    Q = rng.uniform(-10, 110, (300, 6))
+
+    np.testing.assert_allclose(flat.predict_batch(Q), forest.predict(Q), rtol=0, atol=1e-9)
+    for q in Q[:50]:
+        assert abs(flat.predict(q) - forest.predict(q.reshape(1, -1))[0]) < 1e-9
+
+
+def test_flat_forest_cache_keys_on_exact_features():
+    forest, _ = make_forest()
+    flat = td.FlatForest(forest)
+    # Find two inputs closer than 0.01 that fall on different sides of a split
+    split = forest.estimators_[0].tree_.threshold[0]
+    feature = forest.estimators_[0].tree_.feature[0]
+    a = np.full(6, 50.0)
+    b = a.copy()
+    a[feature], b[feature] = split - 0.004, split + 0.004
+
+    for q in (a, b):
+        assert abs(flat.predict(q, "c1") - forest.predict(q.reshape(1, -1))[0]) < 1e-9
+    assert flat.cache_misses == 2
+
+
+def test_engine_keeps_vehicles_without_timestamps():
+    engine = td.MultiVehicleTurnEngine(workers=0, smoother=td.GPSSmoother)
+    engine.ingest([("a", 36.80, 10.00, 40.0), ("b", 36.81, 10.01, 40.0, 1000.0)])
+
+    assert engine.evict_idle(before_timestamp=2000.0) == 1           # only "b"
+    assert set(engine.local_tracks) == {"a"}
+    assert engine.evict_idle(idle_s=3600.0) == 0
+    assert engine.evict_idle(idle_s=0.0) == 1
+
+
+def test_smoother_factory_or_instance():
+    smoother = td.GPSSmoother()
+    assert td.SmartTurnSpeedSystem(smoother=smoother).smoother is smoother
+    assert isinstance(td.SmartTurnSpeedSystem(smoother=td.GPSSmoother).smoother, td.GPSSmoother)
+
+    engine = td.MultiVehicleTurnEngine(workers=0, smoother=smoother)
+    engine.ingest([("a", 36.80, 10.00, 40.0, 0.0), ("b", 36.80, 10.00, 40.0, 0.0)])
+    a, b = engine.local_tracks["a"].smoother, engine.local_tracks["b"].smoother
+    assert isinstance(a, td.GPSSmoother) and a is not b and a is not smoother
+
+
+def test_turn_map_save_load_and_merge_from_path(tmp_path):
+    db = td.TurnDatabase()
+    db.add_new_turn((36.80, 10.00), 30.0, 40.0)
+    db.add_new_turn((36.90, 10.10), 60.0, 70.0)
+    path = tmp_path / "turns.npy"
+    db.save(path)
+
+    loaded = td.TurnDatabase.load(path)
+    assert loaded.turns == db.turns
+
+    fleet = td.TurnDatabase()
+    assert fleet.merge(path) == (0, 2)          # pathlib.Path, not only str
+    assert fleet.merge(str(path)) == (2, 0)
+
+
+def test_smoother_keeps_the_input_rate_unless_out_hz_is_set():
+    t = np.arange(50) / 10.0
+    lats, lons, speeds = 36.80 + t * 1e-5, np.full(50, 10.0), np.full(50, 40.0)
+
+    smoother = td.GPSSmoother()
+    assert all(smoother.update(*f) is not None for f in zip(lats, lons, speeds, t))
+    assert len(td.smooth_trip(lats, lons, speeds, t)[0]) == 50
+
+    smoother = td.GPSSmoother(out_hz=1.0)
+    assert sum(smoother.update(*f) is not None for f in zip(lats, lons, speeds, t)) == 5
+    assert len(td.smooth_trip(lats, lons, speeds, t, out_hz=1.0)[0]) == 5